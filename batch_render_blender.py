@@ -1,5 +1,5 @@
 # a script for batch rendering multiple objects
-# The script will run a render script per object
+# The script will run a render script per object, keeping up to -workers Blender processes busy at once
 
 import sys, os
 import os.path
@@ -7,10 +7,27 @@ import argparse
 from platform import system
 import subprocess
 import logging
+import threading
+import time
+import json
+import queue
+import itertools
+import socket
+import copy
+import shutil
+import hashlib
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-LOG_FORMAT = "%(asctime)s %(message)s"
+from render_manifest import RenderManifest, file_digest, job_key
+from cost_model import CostModel, obj_stats
+from render_telemetry import TelemetryLog, Progress, read_events, summarize_events, count_images
+from work_queue import LeaseQueue, object_key, parse_shard, shard_of
+from render_profiles import RENDER_PROFILES
+
+LOG_FORMAT = "%(asctime)s [%(threadName)s] %(message)s"
 logging.basicConfig(
-            filename='batch_render.log', 
+            filename='batch_render.log',
             level=logging.DEBUG,
             format=LOG_FORMAT)
 
@@ -18,58 +35,846 @@ logging.basicConfig(
 parser = argparse.ArgumentParser(description='Execute render script on multiple obj files')
 parser.add_argument('-path', type=str, help='Path to the directory which holds object files (in their directories')
 parser.add_argument('--views', type=int, default=50, help='number of views to be rendered for each object')
+parser.add_argument('-num_of_lights', type=int, default=1, help='number of light angles to be rendered for each view')
+parser.add_argument('-resolution', type=int, default=300, help='W,H of final rendered products')
+parser.add_argument('--scale', type=float, default=1, help='Scaling factor applied to models')
+parser.add_argument('--depth_scale', type=float, default=1.4, help='Scaling that is applied to depth')
+parser.add_argument('--color_depth', type=str, default=None, choices=['8', '16'], help='bits per channel of the PNG output')
+parser.add_argument('--light_groups', action='store_true',
+                    help='render all lights of a view in one pass (blender 3.2+), each light gets about 1/num_of_lights of the samples')
+parser.add_argument('--animation', action='store_true', help='render each object as one keyframed animation job')
+parser.add_argument('--preview', action='store_true',
+                    help='quick look at every object (decimated mesh, first view and light, low resolution) and a contact '
+                         'sheet per folder in <output_path>/contact_sheets')
+parser.add_argument('--mesh_cache', type=str, default=None, help='directory the render script caches cleaned up meshes in')
+parser.add_argument('--device', type=str, default=None, choices=['cpu', 'gpu', 'auto'], help='Cycles device of the render script')
+parser.add_argument('--profile', type=str, default=None, choices=sorted(RENDER_PROFILES),
+                    help='named quality profile of the render script, see render_profiles.py')
+parser.add_argument('--output_format', type=str, default=None, choices=['png', 'npy'], help='output format of the render script')
+parser.add_argument('--async_write', type=int, default=0, help='PNG writer threads per render process, 0 to write from the compositor')
+parser.add_argument('--scratch_dir', type=str, default=None, help='staging directory for raw passes, defaults to /dev/shm or the temp directory')
+parser.add_argument('--light_sampling', type=str, default=None, choices=['uniform', 'stratified', 'fibonacci'],
+                    help='light direction strategy of the render script')
+parser.add_argument('--seed', type=int, default=None, help='base seed of the light directions')
+parser.add_argument('--auto_frame', type=str, default=None, choices=['none', 'border', 'crop'],
+                    help='render only the pixels the object covers in each view')
 parser.add_argument('-output_path', type=str, default="/home/toky/asaf/rendered_data/", help='Path to the directory which renders will be written in')
 parser.add_argument('-max_objects', type=int, default=-1, help='maximum number of objects to be rendered')
+parser.add_argument('-min_depth', type=int, default=1,
+                    help='shallowest directory level (relative to -path) whose files are rendered. 1 means the object folders')
+parser.add_argument('-max_depth', type=int, default=1, help='deepest directory level searched for objects, -1 for no limit')
+parser.add_argument('-include', type=str, nargs='+', default=['*.obj'], help='file name patterns of objects to render')
+parser.add_argument('-exclude', type=str, nargs='+', default=[],
+                    help='patterns (matched against the path relative to -path) of files and directories to skip')
 parser.add_argument('-render_script', type=str, default="render_blender.py", help='Rendering script')
 parser.add_argument('-max_render_time_per_view', type=int, default=600, help='max time for single object to be rendered')
-
-args = parser.parse_args()
-max_objects = args.max_objects
-objects_dir = args.path
+parser.add_argument('-blender', type=str, default=None, help='Path to the blender executable. Defaults to a per-platform install location')
+parser.add_argument('-workers', type=int, default=1, help='number of Blender processes rendering concurrently')
+parser.add_argument('-threads_per_worker', type=int, default=None,
+                    help='Cycles thread cap (blender -t) for each worker. Defaults to the --profile thread count, '
+                         'or cpu_count / workers when workers > 1')
+parser.add_argument('-log_dir', type=str, default="batch_logs",
+                    help='Directory for per-object Blender output when running more than one worker')
+parser.add_argument('-server', action='store_true',
+                    help='Start one long-lived render server per worker and stream objects into it, instead of one blender per object')
+parser.add_argument('-manifest', type=str, default=None,
+                    help='JSONL file recording finished objects, used to resume a batch. Defaults to <output_path>/render_manifest.jsonl')
+parser.add_argument('-retry_failed', action='store_true', help='render objects again whose last recorded run failed or timed out')
+parser.add_argument('-telemetry', type=str, default=None,
+                    help='JSONL file receiving one record per object (timings, peak memory, images, failure cause) and progress. '
+                         'Defaults to <output_path>/batch_telemetry.jsonl')
+parser.add_argument('-schedule', type=str, default='walk', choices=['walk', 'cost'],
+                    help='walk renders objects in directory order as they are found. cost lists all objects first, renders '
+                         'the most expensive ones first and derives each timeout from the estimated render time')
+parser.add_argument('-cost_model', type=str, default=None,
+                    help='JSON file keeping the durations of completed jobs the cost estimates are fitted to. '
+                         'Defaults to <output_path>/cost_model.json')
+parser.add_argument('-timeout_factor', type=float, default=3.0, help='cost schedule: timeout as a multiple of the estimated time')
+parser.add_argument('-min_timeout', type=float, default=60, help='cost schedule: lower bound of the derived timeouts in seconds')
+parser.add_argument('-shard', type=parse_shard, default=None,
+                    help='i/N: render only the i-th of N disjoint parts of the catalogue (by a hash of the object path), one per node')
+parser.add_argument('-queue', type=str, default=None,
+                    help='shared directory through which several nodes hand out objects with lease files, see work_queue.py')
+parser.add_argument('-node', type=str, default=None, help='name of this node in the queue and its file names. Defaults to the host name')
+parser.add_argument('-lease_seconds', type=float, default=120,
+                    help='a lease not renewed for this long is taken over by another node. Has to exceed the clock skew between nodes')
+parser.add_argument('-validate', action='store_true',
+                    help='check the output of every rendered object while the batch runs and render failed objects again '
+                         'with adjusted parameters, see output_validator.py')
+parser.add_argument('-validate_retries', type=int, default=1, help='times an object that failed validation is rendered again')
+parser.add_argument('-validate_workers', type=int, default=1, help='threads validating rendered objects')
+parser.add_argument('-progress_interval', type=float, default=30,
+                    help='seconds between printed throughput / ETA summaries, 0 to print one after every object')
 
 
 if system() == 'Windows':
     blender_path = 'C:\Program Files\Blender Foundation\Blender 2.82'
-    blender_exec = os.path.join(blender_path, 'blender.exe')
-    blender_exec = ('\"' + blender_exec + '\" ')  # fixes windows spaces in directories
+    default_blender_exec = os.path.join(blender_path, 'blender.exe')
 else: # linux
     # blender_path = '/home/blender/'
-    # blender_exec = os.path.join(blender_path, 'blender', 'blender')
-    # blender_exec = "blender "  # if installed using snap-store or has an alias
-    blender_exec = "~/blender/blender-2.82a-linux64/blender "
-object_files = []
-
-path, dirs, files = next(os.walk(objects_dir))
-for dir_ in dirs:
-    obj_path, obj_dirs, obj_files = next(os.walk(os.path.join(objects_dir,dir_)))
-    for file in obj_files:
-        if file.endswith(".obj"):
-            object_files.append(os.path.join(obj_path, file))
-
-if not os.path.isfile(args.render_script):
-    quit("Can't find render_blender script")
-
-logging.info("Started rendering sequence, saving results in {}".format(args.output_path))
-for idx, obj_file in enumerate(object_files):
-    run_cmd = blender_exec + " -b -P " + args.render_script+ " -- -obj " + obj_file + " -output_folder " + args.output_path
-    # print(run_cmd)
+    # default_blender_exec = os.path.join(blender_path, 'blender', 'blender')
+    # default_blender_exec = "blender"  # if installed using snap-store or has an alias
+    default_blender_exec = "~/blender/blender-2.82a-linux64/blender"
+
+
+# children that are currently running, so they can be killed on Ctrl+C
+running_procs = set()
+running_procs_lock = threading.Lock()
+
+
+# lazily yields object files below objects_dir, depth first and sorted within each directory.
+# Files directly in objects_dir are at depth 0, files in its subdirectories at depth 1 and so on.
+# Nothing is listed ahead of what the consumer asks for, so rendering starts right away and
+# the walk stops as soon as the consumer does.
+# walked, when given, is called with the share of the tree walked so far whenever a directory without
+# subdirectories is done. Each directory's share is split evenly between its subdirectories
+def iter_object_files(objects_dir, min_depth=1, max_depth=1, include=('*.obj',), exclude=(), walked=None):
+    stack = [(objects_dir, 0, 1.0)]
+    done = 0.0
+    while stack:
+        directory, depth, share = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as error:
+            logging.warning("Can't list {}: {}".format(directory, error))
+            entries = []
+
+        subdirs = []
+        for entry in entries:
+            relative_path = os.path.relpath(entry.path, objects_dir)
+            if any(fnmatch(relative_path, pattern) for pattern in exclude):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)  # like os.walk, never descend into links
+            except OSError:
+                continue
+            if is_dir:
+                if max_depth < 0 or depth < max_depth:
+                    subdirs.append(entry.path)
+            elif depth >= min_depth and any(fnmatch(entry.name, pattern) for pattern in include):
+                yield entry.path
+        if subdirs:
+            stack.extend((path, depth + 1, share / len(subdirs)) for path in reversed(subdirs))
+        else:
+            done += share
+            if walked:
+                walked(min(done, 1.0))
+
+
+def threads_per_worker(args):
+    if args.threads_per_worker is not None:
+        return args.threads_per_worker
+    profile_threads = RENDER_PROFILES[args.profile]['threads'] if args.profile else 0
+    if profile_threads:
+        return min(profile_threads, os.cpu_count() or 1)
+    if args.workers <= 1:
+        return 0  # let blender decide, as before
+    return max(1, (os.cpu_count() or 1) // args.workers)
+
+
+# boolean render_blender.py options forwarded as --<name>
+RENDER_SWITCHES = ['light_groups', 'animation', 'preview']
+# render_blender.py options forwarded as --<name> <value> when given
+RENDER_OPTIONS = ['profile', 'output_format', 'light_sampling', 'seed', 'auto_frame', 'color_depth']
+
+
+# the render arguments an object's output depends on. They are forwarded to the render script
+# and are part of the manifest key, so changing any of them renders the object again.
+# Switches and options are only added when given, so manifests written before a switch existed stay valid
+def render_params(args):
+    params = {'views': args.views, 'num_of_lights': args.num_of_lights, 'resolution': args.resolution,
+              'scale': args.scale, 'depth_scale': args.depth_scale}
+    for switch in RENDER_SWITCHES:
+        if getattr(args, switch):
+            params[switch] = True
+    for option in RENDER_OPTIONS:
+        if getattr(args, option) is not None:
+            params[option] = getattr(args, option)
+    return params
+
+
+def render_script_args(args):
+    params = render_params(args)
+    script_args = ["--views", str(params['views']), "-num_of_lights", str(params['num_of_lights']),
+                   "-resolution", str(params['resolution']), "--scale", str(params['scale']),
+                   "--depth_scale", str(params['depth_scale']), "-output_folder", args.output_path]
+    for switch in RENDER_SWITCHES:
+        if params.get(switch):
+            script_args.append("--" + switch)
+    for option in RENDER_OPTIONS:
+        if option in params:
+            script_args += ["--" + option, str(params[option])]
+    # these do not change the images, so they are not part of render_params
+    if args.mesh_cache:
+        script_args += ["--mesh_cache", args.mesh_cache]
+    if args.device:
+        script_args += ["--device", args.device]
+    if args.async_write:
+        script_args += ["--async_write", str(args.async_write)]
+    if args.scratch_dir:
+        script_args += ["--scratch_dir", args.scratch_dir]
+    if args.threads_per_worker is not None:
+        script_args += ["--threads", str(args.threads_per_worker)]  # the profile's thread count would replace -t
+    return script_args
+
+
+# the command is passed as a list (no shell), so a timeout kills blender itself and not only a wrapping shell
+def build_command(args, script_args):
+    blender_exec = os.path.expanduser(args.blender or default_blender_exec)
+    cmd = [blender_exec, "-b"]
+    threads = threads_per_worker(args)
+    if threads > 0:
+        cmd += ["-t", str(threads)]  # has to come before -P, blender handles arguments in order
+    cmd += ["-P", args.render_script, "--"] + script_args
+    return cmd
+
+
+def register_proc(proc):
+    with running_procs_lock:
+        running_procs.add(proc)
+
+
+def unregister_proc(proc):
+    with running_procs_lock:
+        running_procs.discard(proc)
+
+
+def kill_running():
+    with running_procs_lock:
+        for proc in running_procs:
+            proc.kill()
+
+
+# waits like Popen.wait(timeout), but reaps the child with os.wait4 to also get its peak resident
+# set size in bytes. Where there is no wait4 (Windows) the peak is None
+def wait_with_rusage(proc, timeout):
+    if not hasattr(os, 'wait4'):
+        return proc.wait(timeout=timeout), None
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            return reaped(proc, status, rusage)
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+def reaped(proc, status, rusage):
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    return proc.returncode, rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# kills a child that ran over its time, returns its peak resident set size like wait_with_rusage
+def kill_with_rusage(proc):
+    proc.kill()
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    return reaped(proc, status, rusage)[1]
+
+
+# peak resident set size in bytes of a process that is still running (linux only, None elsewhere)
+def running_peak_rss(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def exit_cause(returncode):
+    if returncode < 0:
+        return "killed by signal {}".format(-returncode)
+    return "exit code {}".format(returncode)
+
+
+# render a single object, returns 'ok', 'error' or 'timeout' and a dict with the wall time, the peak
+# memory of the blender child and the cause of a failure. Never raises for a failed render,
+# so one broken object does not stop the rest of the queue
+def render_object(args, obj_file, timeout, telemetry_file=None):
+    if args.server:
+        return get_server(args).render(obj_file, timeout, telemetry_file)
+
+    script_args = ["-obj", obj_file, "-model_id", object_identifier(args, obj_file)] + render_script_args(args)
+    if telemetry_file:
+        script_args += ["--telemetry", telemetry_file]
+    cmd = build_command(args, script_args)
     logging.info("Rendering the following object:")
     logging.info(obj_file)
-    
-    # make sure no errors are raised during run. If some error is raised, quit
-    # If a specific render runs more than args.max_render_time_per_view * views minutes, stop it
+
+    log_file = None
+    if args.workers > 1:
+        # interleaved output of several blenders is unreadable, keep one log per object
+        os.makedirs(args.log_dir, exist_ok=True)
+        log_file = open(os.path.join(args.log_dir, object_identifier(args, obj_file) + ".log"), "w")
+
+    start = time.time()
+    info = {'peak_rss': None}
+    try:
+        proc = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT if log_file else None)
+        register_proc(proc)
+        try:
+            returncode, info['peak_rss'] = wait_with_rusage(proc, timeout)
+        except subprocess.TimeoutExpired:
+            info['peak_rss'] = kill_with_rusage(proc)
+            logging.error("The object {} timed out and was stopped".format(obj_file))
+            info.update(wall=time.time() - start, cause="timed out after {}s".format(timeout))
+            return 'timeout', info
+        finally:
+            unregister_proc(proc)
+    finally:
+        if log_file:
+            log_file.close()
+
+    info['wall'] = time.time() - start
+    if returncode != 0:
+        logging.error("The following command caused an error: {}".format(subprocess.list2cmdline(cmd)))
+        logging.error("Error during run: exit code {}".format(returncode))
+        info['cause'] = exit_cause(returncode)
+        return 'error', info
+    return 'ok', info
+
+
+# must match the protocol in render_blender.py server_flow()
+SERVER_READY = 'RENDER_SERVER_READY'
+SERVER_RESPONSE = 'RENDER_SERVER_DONE '
+
+
+# A blender process running render_blender.py -server. Jobs are written to its stdin, a reader
+# thread forwards blender's output to a log file and hands protocol lines back through a queue.
+# A server that times out or dies is killed and started again for the next job.
+class RenderServer:
+    def __init__(self, args, name):
+        self.args = args
+        self.name = name
+        self.proc = None
+        self.lines = None
+
+    def start(self, timeout):
+        cmd = build_command(self.args, ["-server"] + render_script_args(self.args))
+        logging.info("Starting render server {}".format(self.name))
+        os.makedirs(self.args.log_dir, exist_ok=True)
+        log_file = open(os.path.join(self.args.log_dir, self.name + ".log"), "a")
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True, bufsize=1)
+        register_proc(self.proc)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_output, args=(self.proc, self.lines, log_file),
+                         name=self.name + "_reader", daemon=True).start()
+        if self._wait_for(SERVER_READY, timeout) is None:
+            self.kill()
+            raise RuntimeError("Render server {} failed to start".format(self.name))
+
+    @staticmethod
+    def _read_output(proc, lines, log_file):
+        with log_file:
+            for line in proc.stdout:
+                if line.startswith(SERVER_READY) or line.startswith(SERVER_RESPONSE):
+                    lines.put(line.rstrip("\n"))
+                else:
+                    log_file.write(line)
+        lines.put(None)  # EOF, the server exited
+
+    # returns the next protocol line starting with prefix, or None on timeout / exit
+    def _wait_for(self, prefix, timeout):
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if line is None or not line.startswith(prefix):
+            return None
+        return line[len(prefix):]
+
+    # same results as render_object. The peak memory is the server's peak since it started
+    def render(self, obj_file, timeout, telemetry_file=None):
+        logging.info("Rendering the following object on {}:".format(self.name))
+        logging.info(obj_file)
+        start = time.time()
+        info = {'peak_rss': None, 'server': self.name}
+        job = {'obj': obj_file, 'model_id': object_identifier(self.args, obj_file)}
+        if telemetry_file:
+            job['telemetry'] = telemetry_file
+        try:
+            if self.proc is None:
+                self.start(timeout)
+            self.proc.stdin.write(json.dumps(job) + "\n")
+            self.proc.stdin.flush()
+        except (OSError, RuntimeError) as error:
+            logging.exception("Render server {} is not available".format(self.name))
+            self.kill()
+            info.update(wall=time.time() - start, cause="server not available: {}".format(error))
+            return 'error', info
+
+        response = self._wait_for(SERVER_RESPONSE, timeout)
+        info['wall'] = time.time() - start
+        if response is None:
+            if self.proc.poll() is None:
+                logging.error("The object {} timed out and was stopped".format(obj_file))
+                info['peak_rss'] = running_peak_rss(self.proc.pid)
+                self.kill()
+                info['cause'] = "timed out after {}s".format(timeout)
+                return 'timeout', info
+            logging.error("Render server {} exited with code {} while rendering {}".format(
+                self.name, self.proc.returncode, obj_file))
+            info['cause'] = "server " + exit_cause(self.proc.returncode)
+            self.kill()
+            return 'error', info
+
+        info['peak_rss'] = running_peak_rss(self.proc.pid)
+        response = json.loads(response)
+        if response['status'] != 'ok':
+            logging.error("Error during run of {}: {}".format(obj_file, response.get('error')))
+            info['cause'] = response.get('error')
+            return 'error', info
+        return 'ok', info
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        self.kill()
+
+    def kill(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        unregister_proc(self.proc)
+        self.proc = None
+
+
+# one server per pool thread, created lazily
+worker_state = threading.local()
+servers = []
+servers_lock = threading.Lock()
+
+
+def get_server(args):
+    server = getattr(worker_state, 'server', None)
+    if server is None:
+        with servers_lock:
+            server = RenderServer(args, "server_{}".format(len(servers)))
+            servers.append(server)
+        worker_state.server = server
+    return server
+
+
+# name of an object's output folder, log and telemetry files: the folders from -path down to the object
+# joined by '_', so the objects of a deep tree (<synset>/<id>/models/model.obj) don't share a name.
+# Objects in the object folders (-max_depth 1) keep the name of their folder
+def object_identifier(args, obj_file):
+    folder = os.path.relpath(os.path.dirname(os.path.abspath(obj_file)), os.path.abspath(args.path))
+    if folder == os.curdir:
+        return os.path.basename(os.path.abspath(args.path))
+    return folder.replace(os.sep, '_')
+
+
+# identifiers of this batch and the object that has each, see claim_identifier()
+identifiers = {}
+identifiers_lock = threading.Lock()
+
+
+# two objects with the same identifier (several obj files in one folder, or folder names that only
+# differ in '_' and '/') would overwrite each other's output. The first one keeps it
+def claim_identifier(args, obj_file):
+    identifier = object_identifier(args, obj_file)
+    with identifiers_lock:
+        owner = identifiers.setdefault(identifier, obj_file)
+    return None if owner == obj_file else owner
+
+
+# where render_blender.py writes an object's images
+def object_output_dir(args, obj_file):
+    return os.path.abspath(os.path.join(args.output_path, object_identifier(args, obj_file)))
+
+
+# side channel file the render script reports an object's view and light timings to
+def object_telemetry_file(args, obj_file):
+    return os.path.abspath(os.path.join(args.log_dir, 'telemetry', object_identifier(args, obj_file) + '.jsonl'))
+
+
+# images the render script writes per object, a preview only renders the first view and light
+def images_per_object(args):
+    return 1 if args.preview else args.views * args.num_of_lights
+
+
+# render settings the cost of an image depends on, each combination has its own cost model.
+# Views and lights are inputs of the model, seeds and light placement do not change the cost
+def cost_config(args):
+    config = {key: value for key, value in render_params(args).items()
+              if key not in ('views', 'num_of_lights', 'seed', 'light_sampling')}
+    config.update(device=args.device, threads=threads_per_worker(args), workers=args.workers, server=args.server)
+    return config
+
+
+# with the cost schedule the timeout follows the estimated render time, once the cost model was
+# fitted to enough completed jobs. Until then, and with the walk schedule, the fixed timeout applies
+def job_timeout(args, cost_model, estimate, default_timeout):
+    if args.schedule != 'cost' or not cost_model.fitted:
+        return default_timeout
+    return max(args.min_timeout, args.timeout_factor * estimate)
+
+
+# lists every object up front and orders them by estimated cost, most expensive first. Starting the
+# long jobs first keeps all workers busy until the end of the batch (longest processing time first).
+# Face counts are estimated from file sizes here, reading every mesh would hold up the start
+def schedule_by_cost(args, cost_model, object_files):
+    images = images_per_object(args)
+    jobs = []
+    for obj_file in object_files:
+        try:
+            size = os.path.getsize(obj_file)
+        except OSError:
+            size = 0
+        jobs.append((cost_model.predict(cost_model.faces_from_size(size), images), obj_file))
+    jobs.sort(key=lambda job: -job[0])  # stable, equal estimates stay in directory order
+    logging.info("Scheduled {} objects by estimated cost".format(len(jobs)))
+    return [obj_file for _, obj_file in jobs]
+
+
+# render an object unless the manifest already has it completed with the same parameters (or force is set).
+# The outcome is appended to the manifest, so a crashed or interrupted batch can be resumed,
+# and reported as an 'object' record to the telemetry log
+def process_object(args, manifest, telemetry, progress, cost_model, obj_file, timeout, force=False):
+    owner = claim_identifier(args, obj_file)
+    if owner is not None:
+        cause = "output folder {} is already used by {}".format(object_identifier(args, obj_file), owner)
+        logging.error("Not rendering {}: {}".format(obj_file, cause))
+        telemetry.emit('object', obj=obj_file, status='error', cause=cause)
+        progress.add('error')
+        return 'error'
+    try:
+        digest = hashlib.sha256()  # the content hash of render_manifest.file_digest, read in the same pass
+        vertices, faces = obj_stats(obj_file, digest=digest)
+        content_hash = digest.hexdigest()
+        size = os.path.getsize(obj_file)
+    except OSError as error:
+        logging.exception("Can't read {}".format(obj_file))
+        telemetry.emit('object', obj=obj_file, status='error', cause="can't read: {}".format(error))
+        progress.add('error')
+        return 'error'
+    params = render_params(args)
+    output_dir = object_output_dir(args, obj_file)
+    key = job_key(content_hash, params, output_dir)
+
+    previous = manifest.status(key)
+    if not force and (previous == 'ok' or (previous is not None and not args.retry_failed)):
+        logging.info("Skipping {}, manifest status is {}".format(obj_file, previous))
+        telemetry.emit('object', obj=obj_file, status='skipped', manifest_status=previous)
+        progress.add('skipped')
+        return 'skipped'
+
+    telemetry_file = object_telemetry_file(args, obj_file)
+    os.makedirs(os.path.dirname(telemetry_file), exist_ok=True)
+    if os.path.isfile(telemetry_file):
+        os.remove(telemetry_file)
+    attempt = manifest.attempts(key) + 1
+    images_expected = images_per_object(args)
+    estimate = cost_model.predict(faces, images_expected)
+    fixed_timeout, timeout = timeout, job_timeout(args, cost_model, estimate, timeout)
+
+    status, info = render_object(args, obj_file, timeout, telemetry_file)
+    if status == 'timeout':
+        cost_model.observe(faces, size, images_expected, timeout, lower_bound=True)
+        if timeout < fixed_timeout:
+            # the estimate was too low, it does not get to fail the object on its own
+            logging.warning("{} timed out after the estimated {:.0f}s, rendering it again with the fixed timeout {}s".format(
+                obj_file, timeout, fixed_timeout))
+            if os.path.isfile(telemetry_file):
+                os.remove(telemetry_file)
+            derived_timeout, timeout = timeout, fixed_timeout
+            status, info = render_object(args, obj_file, timeout, telemetry_file)
+            info['derived_timeout'] = derived_timeout
+            if status == 'timeout':
+                cost_model.observe(faces, size, images_expected, timeout, lower_bound=True)
+    if status == 'ok':
+        cost_model.observe(faces, size, images_expected, info['wall'])
+    images = count_images(output_dir) if os.path.isdir(output_dir) else 0
+    manifest.record(key, obj_file, content_hash, params, status, attempt=attempt)
+    telemetry.emit('object', obj=obj_file, output_dir=output_dir, status=status, attempt=attempt,
+                   retries=attempt - 1, images=images, worker=threading.current_thread().name, faces=faces,
+                   vertices=vertices, estimated_seconds=estimate, timeout=timeout,
+                   **dict(info, **summarize_events(read_events(telemetry_file))))
+    progress.add(status, info['wall'], images)
+    return status
+
+
+# with -queue, an object is only rendered by the node holding its lease. Returns 'held' when another
+# node is rendering it right now, the caller tries again later in case that node dies
+def process_queued_object(args, queue, manifest, telemetry, progress, cost_model, obj_file, timeout):
+    key = object_key(os.path.relpath(obj_file, args.path))
+    state = queue.claim(key, obj_file)
+    if state == LeaseQueue.DONE:
+        logging.info("Skipping {}, already processed by a node of the queue".format(obj_file))
+        telemetry.emit('object', obj=obj_file, status='skipped', queue_status='done')
+        progress.add('skipped')
+        return 'skipped'
+    if state == LeaseQueue.HELD:
+        return 'held'
+    status = 'error'
+    try:
+        status = process_object(args, manifest, telemetry, progress, cost_model, obj_file, timeout)
+    finally:
+        queue.complete(key, status, obj_file)
+    return status
+
+
+# checks the output of a rendered object (-validate). The metrics go to <object>/quality.json and a
+# 'validation' telemetry record, a failed object is recorded as 'invalid' in the manifest. Returns the
+# problems found and the arguments to render it again with, None when the output is fine or the object
+# is out of retries
+def validate_output(args, job_args, manifest, telemetry, obj_file, requeues):
+    from output_validator import validate_object, adjusted_params, retryable, write_report  # numpy, only needed with -validate
+
+    params = render_params(job_args)
+    output_dir = object_output_dir(job_args, obj_file)
+    start = time.time()
+    report = validate_object(output_dir, params)
+    if os.path.isdir(output_dir):
+        write_report(output_dir, report)
+    changes = adjusted_params(params, report['problems'])
+    retry = retryable(report['problems']) and requeues < args.validate_retries
+    telemetry.emit('validation', obj=obj_file, output_dir=output_dir, status='invalid' if report['problems'] else 'ok',
+                   seconds=time.time() - start, requeues=requeues, requeued=retry, changes=changes if retry else {},
+                   **report)
+    if not report['problems']:
+        return [], None
+
+    logging.warning("Output of {} failed validation: {}".format(obj_file, ', '.join(report['problems'])))
     try:
-        a = subprocess.check_call(run_cmd, shell=True, timeout=args.max_render_time_per_view * args.views)
-    except subprocess.CalledProcessError as error:
-        logging.error("The following command caused an error: {}".format(run_cmd))
-        quit("Error during run: {}".format(error))
-    except subprocess.TimeoutExpired:
-        logging.error("The object {} timed out and was stopped".format(obj_file))
-    except KeyboardInterrupt as e:
-        logging.exception("Run killed by user")
-        
+        content_hash = file_digest(obj_file)
+    except OSError:
+        logging.exception("Can't read {}".format(obj_file))
+        return report['problems'], None
+    key = job_key(content_hash, params, output_dir)
+    manifest.record(key, obj_file, content_hash, params, 'invalid', attempt=manifest.attempts(key),
+                    problems=report['problems'])
+    if not retry:
+        return report['problems'], None
+    retry_args = copy.copy(job_args)
+    for name, value in changes.items():
+        setattr(retry_args, name, value)
+    retry_args.server = False  # a render server keeps the depth_scale it was started with
+    logging.info("Rendering {} again with {}".format(obj_file, changes))
+    return report['problems'], retry_args
+
+
+# one contact sheet per folder of the catalogue, named after the folder relative to -path.
+# Objects that failed are on the sheet too, as empty tiles
+def write_contact_sheets(args, object_files):
+    from contact_sheet import write_contact_sheet  # numpy, only needed for previews
+
+    folders = {}
+    for obj_file in object_files:
+        folder = os.path.dirname(os.path.relpath(os.path.dirname(obj_file), args.path))
+        folders.setdefault(folder, set()).add(object_output_dir(args, obj_file))
+    for folder, output_dirs in sorted(folders.items()):
+        name = folder.replace(os.sep, '_') if folder else os.path.basename(os.path.abspath(args.path))
+        path = os.path.join(args.output_path, 'contact_sheets', name + '.png')
+        cells = write_contact_sheet(output_dirs, path)
+        flagged = [cell for cell in cells if cell['status'] != 'ok']
+        logging.info("Contact sheet {}: {} objects, {} flagged".format(path, len(cells), len(flagged)))
+        print("Contact sheet {}: {} objects, {} flagged".format(path, len(cells), len(flagged)))
+
+
+# the objects of this batch: the walk, restricted to this node's shard and to -max_objects
+def select_objects(args, walked=None):
+    object_files = iter_object_files(args.path, args.min_depth, args.max_depth, args.include, args.exclude, walked)
+    if args.shard:
+        index, shards = args.shard
+        object_files = (obj_file for obj_file in object_files
+                        if shard_of(os.path.relpath(obj_file, args.path), shards) == index)
+    if args.max_objects >= 0:
+        object_files = itertools.islice(object_files, args.max_objects)
+    return object_files
+
+
+# passes the walk through, counting the objects found, and sets the total of progress once it ended.
+# Until then progress estimates the total from the objects found in the share of the tree walked
+# (select_objects(args, progress.walked)), so the tree is only walked once, which matters on large
+# network file systems, and there is an ETA while the walk is only a few jobs ahead of the renders
+def counted(object_files, progress):
+    for obj_file in object_files:
+        progress.found_object()
+        yield obj_file
+    progress.total = progress.found
+
+
+# nodes sharing an output path keep their own manifest and telemetry files
+def node_file_name(args, name, extension):
+    if args.queue:
+        name += '_' + args.node
+    elif args.shard:
+        name += '_shard{}of{}'.format(*args.shard)
+    return name + extension
+
+
+def main():
+    args = parser.parse_args()
+    objects_dir = args.path
+    if args.validate:
+        # Pillow logs every PNG chunk it decodes at DEBUG, which would bury this log
+        logging.getLogger('PIL').setLevel(logging.INFO)
+    args.node = args.node or socket.gethostname()
+
+    if not os.path.isfile(args.render_script):
+        quit("Can't find render_blender script")
+
+    progress = Progress(args.workers, args.max_objects if args.max_objects >= 0 else None)
+    object_files = select_objects(args, progress.walked)
+
+    # If a specific render runs more than args.max_render_time_per_view * views seconds, stop it.
+    # The cost schedule replaces this by a timeout per object once its cost model is fitted
+    timeout = args.max_render_time_per_view * args.views
+    cost_model = CostModel(args.cost_model or os.path.join(args.output_path, "cost_model.json"), cost_config(args))
+
+    manifest = RenderManifest(args.manifest or os.path.join(args.output_path, node_file_name(args, "render_manifest", ".jsonl")))
+    telemetry = TelemetryLog(args.telemetry or os.path.join(args.output_path, node_file_name(args, "batch_telemetry", ".jsonl")))
+    queue = LeaseQueue(args.queue, args.node, args.lease_seconds, args.retry_failed) if args.queue else None
+    if args.schedule == 'cost':
+        object_files = schedule_by_cost(args, cost_model, object_files)
+        progress.total = len(object_files)
+    else:
+        object_files = counted(object_files, progress)
+    telemetry.emit('batch_start', path=os.path.abspath(objects_dir), output_path=os.path.abspath(args.output_path),
+                   workers=args.workers, server=args.server, timeout=timeout, params=render_params(args), node=args.node,
+                   shard=args.shard, queue=args.queue)
+
+    logging.info("Started rendering sequence with {} worker(s), saving results in {}".format(args.workers, args.output_path))
+    results = {'ok': 0, 'error': 0, 'timeout': 0, 'skipped': 0, 'invalid': 0}
+    # objects are submitted while the directory walk is still going. Only a few jobs per worker
+    # are queued ahead, so the walk never runs far in front of the renders
+    max_pending = 2 * args.workers
+    pending = {}
+    held = []  # objects another node of the queue was rendering, tried again once the walk is done
+    finished = []  # objects processed by this node, for the contact sheets of a preview
+    # with -validate every rendered object is checked on the validation threads while the next ones render.
+    # Objects that fail go back to the front of the render queue with adjusted parameters
+    validation_pool = ThreadPoolExecutor(max_workers=args.validate_workers, thread_name_prefix='validator') if args.validate else None
+    validations = {}
+    requeued = []  # (obj_file, arguments, number of requeues)
+    last_report = [time.time()]
+    # a progress interval of 0 reports after every finished object
+    wait_timeout = args.progress_interval if args.progress_interval > 0 else None
+
+    def collect(done):
+        for future in done:
+            if future in validations:
+                obj_file, job_args, requeues = validations.pop(future)
+                try:
+                    problems, retry_args = future.result()
+                except Exception:
+                    logging.exception("Unexpected failure while validating {}".format(obj_file))
+                    continue
+                if problems:
+                    results['invalid'] += 1
+                if retry_args is not None:
+                    requeued.append((obj_file, retry_args, requeues + 1))
+                    progress.requeue()
+                continue
+            obj_file, job_args, requeues = pending.pop(future)
+            try:
+                result = future.result()
+                if result == 'held':
+                    held.append(obj_file)
+                else:
+                    results[result] += 1
+                    finished.append(obj_file)
+                    if result == 'ok' and validation_pool:
+                        validations[validation_pool.submit(validate_output, args, job_args, manifest, telemetry, obj_file,
+                                                           requeues)] = (obj_file, job_args, requeues)
+            except Exception:
+                logging.exception("Unexpected failure while rendering {}".format(obj_file))
+                results['error'] += 1
+        if (done or wait_timeout) and time.time() - last_report[0] >= args.progress_interval:
+            last_report[0] = time.time()
+            summary = progress.summary()
+            print(summary, flush=True)
+            logging.info(summary)
+            telemetry.emit('progress', **progress.snapshot())
+            cost_model.save()
+
+    def render_job(obj_file, job_args, requeues):
+        if requeues:
+            # other parameters can change the light file names, the earlier output is replaced as a whole
+            shutil.rmtree(object_output_dir(job_args, obj_file), ignore_errors=True)
+            status = process_object(job_args, manifest, telemetry, progress, cost_model, obj_file, timeout, force=True)
+            if queue:
+                queue.complete(object_key(os.path.relpath(obj_file, args.path)), status, obj_file)
+            return status
+        if queue:
+            return process_queued_object(args, queue, manifest, telemetry, progress, cost_model, obj_file, timeout)
+        return process_object(args, manifest, telemetry, progress, cost_model, obj_file, timeout)
+
+    # requeued objects go before the rest of the walk. Returns once every object submitted here
+    # and everything requeued meanwhile was rendered and validated
+    def submit(pool, object_files):
+        object_files = iter(object_files)
+        walking = True
+        while True:
+            if len(pending) < max_pending and (requeued or walking):
+                if requeued:
+                    job = requeued.pop(0)
+                else:
+                    obj_file = next(object_files, None)
+                    if obj_file is None:
+                        walking = False
+                        continue
+                    job = (obj_file, args, 0)
+                pending[pool.submit(render_job, *job)] = job
+                continue
+            if not pending and not validations:
+                break
+            collect(wait(list(pending) + list(validations), timeout=wait_timeout, return_when=FIRST_COMPLETED).done)
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='worker') as pool:
+        try:
+            submit(pool, object_files)
+            # objects leased by other nodes are done by them, or their lease expires and they come back here
+            while held:
+                logging.info("{} objects are leased by other nodes, checking again".format(len(held)))
+                time.sleep(args.lease_seconds / 4.0)
+                retry = list(held)
+                del held[:]
+                submit(pool, retry)
+        except KeyboardInterrupt:
+            logging.exception("Run killed by user")
+            for future in list(pending) + list(validations):
+                future.cancel()
+            kill_running()
+            raise
+        finally:
+            if validation_pool:
+                validation_pool.shutdown(wait=True)
+            for server in servers:
+                server.stop()
+            if queue:
+                queue.close()
+            manifest.close()
+            cost_model.save()
+            telemetry.emit('batch_end', results=results, **progress.snapshot())
+            telemetry.close()
 
-    if idx == max_objects:
-        break
+    logging.info("Finished rendering sequence: {} rendered, {} failed, {} timed out, {} skipped, {} failed validation".format(
+        results['ok'], results['error'], results['timeout'], results['skipped'], results['invalid']))
+    if args.preview:
+        write_contact_sheets(args, finished)
+    print(progress.summary())
 
 
+if __name__ == '__main__':
+    main()
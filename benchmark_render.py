@@ -0,0 +1,230 @@
+# Benchmarks render_blender.py and batch_render_blender.py.
+# Sweeps mesh size, resolution, views, lights and color depth, runs every combination and reports
+# wall time, images per second and (for single renders) the time per phase of the render script
+# (blender startup, import, mesh cleanup, node setup, renders, writes) as JSON.
+#
+# -stub runs the scripts under plain python with the stand-in bpy of stub_bpy/, nothing is shaded,
+# so the numbers are the orchestration and I/O overhead only. That needs no blender and is fast
+# enough for CI, where -baseline turns the run into a regression test.
+#
+# Example:
+# python benchmark_render.py -stub -faces 1000 100000 -resolutions 128 300 -output bench.json
+# python benchmark_render.py -stub -baseline bench.json -tolerance 0.3 -render_args="--async_write 2"
+# python benchmark_render.py -blender ~/blender/blender -mode batch -batch_objects 8 -workers 4
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from render_telemetry import count_images
+from render_timing import LAUNCH_TIME_ENV
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STUB_BLENDER = os.path.join(SCRIPT_DIR, 'stub_bpy', 'blender')
+SWEEP_KEYS = ['faces', 'resolution', 'views', 'lights', 'color_depth']
+
+
+# UV sphere of radius 0.3 (fits the camera at scale 1) with about the requested number of triangles
+def write_sphere_obj(path, faces):
+    rings = max(2, int(round(np.sqrt(faces / 4.0))))
+    segments = max(3, int(round(faces / (2.0 * rings))))
+    theta = np.linspace(0, np.pi, rings + 1)[1:-1]
+    phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    ring_vertices = np.stack([np.outer(np.sin(theta), np.cos(phi)), np.outer(np.cos(theta), np.ones(segments)),
+                              np.outer(np.sin(theta), np.sin(phi))], axis=-1).reshape(-1, 3)
+    vertices = np.vstack([[0, 1, 0], ring_vertices, [0, -1, 0]]) * 0.3
+
+    ring = lambda r, s: 2 + r * segments + s % segments  # obj indices start at 1
+    triangles = [[1, ring(0, s + 1), ring(0, s)] for s in range(segments)]
+    for r in range(rings - 2):
+        for s in range(segments):
+            triangles.append([ring(r, s), ring(r, s + 1), ring(r + 1, s + 1)])
+            triangles.append([ring(r, s), ring(r + 1, s + 1), ring(r + 1, s)])
+    bottom = len(vertices)
+    triangles += [[bottom, ring(rings - 2, s), ring(rings - 2, s + 1)] for s in range(segments)]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.writelines('v {:.6f} {:.6f} {:.6f}\n'.format(*vertex) for vertex in vertices)
+        f.writelines('f {} {} {}\n'.format(*triangle) for triangle in triangles)
+    return len(triangles)
+
+
+def blender_command(args):
+    if args.stub:
+        return [sys.executable, STUB_BLENDER]
+    return [os.path.expanduser(args.blender)]
+
+
+def launch_env():
+    env = dict(os.environ)
+    env[LAUNCH_TIME_ENV] = repr(time.time())
+    return env
+
+
+def render_once(args, config, obj_file, work_dir):
+    output_folder = os.path.join(work_dir, 'output')
+    timings_file = os.path.join(work_dir, 'timings.json')
+    cmd = blender_command(args) + ['-b', '-P', os.path.join(SCRIPT_DIR, 'render_blender.py'), '--',
+                                   '-obj', obj_file, '-output_folder', output_folder,
+                                   '--views', str(config['views']), '-num_of_lights', str(config['lights']),
+                                   '-resolution', str(config['resolution']), '--color_depth', str(config['color_depth']),
+                                   '--timings', timings_file] + args.render_args
+    start = time.time()
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=launch_env())
+    wall = time.time() - start
+
+    record = {'returncode': result.returncode, 'wall': wall, 'images': count_images(output_folder)}
+    if os.path.isfile(timings_file):
+        with open(timings_file) as f:
+            record['phases'] = json.load(f)['phases']
+    if result.returncode != 0:
+        record['output_tail'] = result.stdout.decode('utf-8', 'replace')[-2000:]
+    return record
+
+
+# the batch driver over -batch_objects copies of the mesh, each in its own object folder
+def batch_once(args, config, obj_file, work_dir):
+    objects_dir = os.path.join(work_dir, 'objects')
+    for i in range(args.batch_objects):
+        object_dir = os.path.join(objects_dir, 'object{:04d}'.format(i))
+        os.makedirs(object_dir, exist_ok=True)
+        shutil.copyfile(obj_file, os.path.join(object_dir, 'model.obj'))
+    output_folder = os.path.join(work_dir, 'output')
+    blender = STUB_BLENDER if args.stub else os.path.expanduser(args.blender)
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'batch_render_blender.py'), '-path', objects_dir,
+           '-output_path', output_folder, '-blender', blender,
+           '-render_script', os.path.join(SCRIPT_DIR, 'render_blender.py'), '-workers', str(args.workers),
+           '-log_dir', os.path.join(work_dir, 'logs'), '--views', str(config['views']),
+           '-num_of_lights', str(config['lights']), '-resolution', str(config['resolution']),
+           '--color_depth', str(config['color_depth'])] + args.batch_args
+    start = time.time()
+    result = subprocess.run(cmd, cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+
+    record = {'returncode': result.returncode, 'wall': wall, 'images': count_images(output_folder),
+              'objects': args.batch_objects, 'workers': args.workers}
+    if result.returncode != 0:
+        record['output_tail'] = result.stdout.decode('utf-8', 'replace')[-2000:]
+    return record
+
+
+def configs(args):
+    for values in itertools.product(args.faces, args.resolutions, args.views, args.lights, args.color_depths):
+        yield dict(zip(SWEEP_KEYS, values))
+
+
+def config_key(record):
+    return tuple([record['mode']] + [record[key] for key in SWEEP_KEYS])
+
+
+# median images per second per configuration over the repeats
+def throughput(results):
+    runs = {}
+    for record in results:
+        runs.setdefault(config_key(record), []).append(record['images_per_sec'])
+    return {key: float(np.median(values)) for key, values in runs.items()}
+
+
+# configurations at least tolerance (a fraction) slower than in the baseline run
+def regressions(results, baseline, tolerance):
+    current, previous = throughput(results), throughput(baseline['results'])
+    slower = []
+    for key, value in sorted(current.items()):
+        if key in previous and value < previous[key] * (1 - tolerance):
+            slower.append({'config': dict(zip(['mode'] + SWEEP_KEYS, key)),
+                           'images_per_sec': value, 'baseline_images_per_sec': previous[key]})
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the render script and the batch driver')
+    parser.add_argument('-stub', action='store_true', help='run under plain python with the stand-in bpy of stub_bpy/')
+    parser.add_argument('-blender', type=str, default='blender', help='Path to the blender executable (without -stub)')
+    parser.add_argument('-mode', type=str, default='render', choices=['render', 'batch', 'both'],
+                        help='benchmark single renders (with phase timings), the batch driver, or both')
+    parser.add_argument('-faces', type=int, nargs='+', default=[1000, 50000], help='triangle counts of the test meshes')
+    parser.add_argument('-obj', type=str, default=None, help='benchmark this mesh instead of generated spheres')
+    parser.add_argument('-resolutions', type=int, nargs='+', default=[300])
+    parser.add_argument('-views', type=int, nargs='+', default=[5])
+    parser.add_argument('-lights', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('-color_depths', type=str, nargs='+', default=['8'], choices=['8', '16'])
+    parser.add_argument('-repeat', type=int, default=1, help='runs per configuration')
+    parser.add_argument('-batch_objects', type=int, default=4, help='objects per batch run')
+    parser.add_argument('-workers', type=int, default=1, help='-workers of the batch runs')
+    parser.add_argument('-render_args', type=shlex.split, default=[],
+                        help='extra render_blender.py arguments as one string, e.g. -render_args="--async_write 2"')
+    parser.add_argument('-batch_args', type=shlex.split, default=[],
+                        help='extra batch_render_blender.py arguments as one string, e.g. -batch_args="-server"')
+    parser.add_argument('-output', type=str, default=None, help='write the results as JSON to this file')
+    parser.add_argument('-baseline', type=str, default=None,
+                        help='results of an earlier run, exit with 1 if a configuration got slower than -tolerance')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='allowed throughput loss against -baseline')
+    parser.add_argument('-keep', action='store_true', help='keep the rendered output in the work directory')
+    args = parser.parse_args()
+
+    modes = ['render', 'batch'] if args.mode == 'both' else [args.mode]
+    work_root = tempfile.mkdtemp(prefix='render_benchmark_')
+    results = []
+    failed = False
+    try:
+        meshes = {}
+        for faces in args.faces:
+            if args.obj:
+                meshes[faces] = args.obj
+            else:
+                meshes[faces] = os.path.join(work_root, 'meshes', 'sphere{}'.format(faces), 'sphere.obj')
+                write_sphere_obj(meshes[faces], faces)
+        if args.obj:
+            args.faces = args.faces[:1]
+
+        for mode, config, repeat in itertools.product(modes, list(configs(args)), range(args.repeat)):
+            work_dir = os.path.join(work_root, 'run')
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            run = render_once if mode == 'render' else batch_once
+            record = dict(config, mode=mode, repeat=repeat)
+            record.update(run(args, config, meshes[config['faces']], work_dir))
+            record['images_per_sec'] = record['images'] / record['wall'] if record['wall'] > 0 else 0.0
+            failed = failed or record['returncode'] != 0
+            results.append(record)
+            print("{mode:6} faces={faces} res={resolution} views={views} lights={lights} depth={color_depth}: "
+                  "{wall:.2f}s, {images} images, {images_per_sec:.1f} images/s".format(**record), flush=True)
+            if args.keep:
+                shutil.move(work_dir, os.path.join(work_root, '{}_{}'.format(mode, len(results))))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_root, ignore_errors=True)
+        else:
+            print("Output kept in {}".format(work_root))
+
+    report = {'stub': args.stub, 'platform': platform.platform(), 'python': platform.python_version(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if failed:
+        print("Some runs failed, see output_tail in the results")
+        sys.exit(1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for entry in slower:
+            print("Regression: {config} {images_per_sec:.1f} images/s, baseline {baseline_images_per_sec:.1f}".format(**entry))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
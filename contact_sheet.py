@@ -0,0 +1,121 @@
+# Contact sheets of preview renders: one row of tiles (combined image, depth, normal of the first view)
+# per object, several objects per sheet row, so scale, depth_scale and framing of a whole folder can be
+# checked at a glance. The frame of each object tells what the depth map says about it:
+#   green   object in frame
+#   orange  object touches the image border, it is probably cut off (--scale too large)
+#   red     (almost) nothing rendered (--scale too small, or the object is not at the origin)
+#   gray    the object has no rendered images
+# The numbers come from output_validator.depth_stats(), the same the validator judges 'small' and
+# 'cut_off' by, and go to a JSON file next to the sheet.
+#
+# Example:
+# python contact_sheet.py ./preview_output -output ./preview_output/contact_sheet.png
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from dataset_loader import load_image
+from output_validator import MIN_COVERAGE, depth_stats
+from png_io import write_png
+
+TILE_PASSES = ['combined', 'depth', 'normal']
+FRAME = 3
+GAP = 6
+FRAME_COLORS = {'ok': (40, 170, 40), 'edge': (235, 140, 0), 'empty': (210, 30, 30), 'missing': (110, 110, 110)}
+
+
+# paths of the first view's images of a rendered object, None for the ones that are missing
+def preview_images(object_dir):
+    view_dir = os.path.join(object_dir, 'obj_rotat0')
+    combined = sorted(glob.glob(os.path.join(view_dir, 'xyz_*.png')))
+    paths = {'combined': combined[0] if combined else None}
+    for kind in ['depth', 'normal']:
+        path = os.path.join(view_dir, kind + '0001.png')
+        paths[kind] = path if os.path.isfile(path) else None
+    return paths
+
+
+# float RGB in [0, 1]
+def _rgb(pixels):
+    scale = float(np.iinfo(pixels.dtype).max) if pixels.dtype.kind in 'ui' else 1.0
+    pixels = pixels.astype(np.float32) / scale
+    if pixels.shape[2] == 1:
+        pixels = np.repeat(pixels, 3, axis=2)
+    return pixels[..., :3]
+
+
+# nearest neighbour resize to a square tile
+def _fit(pixels, size):
+    rows = (np.arange(size) * pixels.shape[0] // size)
+    cols = (np.arange(size) * pixels.shape[1] // size)
+    return pixels[rows][:, cols]
+
+
+# coverage and framing of an object from its mapped depth map. Background renders as depth 1
+def depth_checks(depth):
+    _, stats = depth_stats(depth)
+    if stats['coverage'] < MIN_COVERAGE:
+        return dict(stats, status='empty')
+    return dict(stats, status='edge' if stats['edge'] else 'ok')
+
+
+def write_contact_sheet(object_dirs, path, columns=4, tile=128):
+    object_dirs = sorted(object_dirs)
+    cell_width = len(TILE_PASSES) * tile + 2 * FRAME
+    cell_height = tile + 2 * FRAME
+    rows = max(1, -(-len(object_dirs) // columns))
+    width = min(columns, max(len(object_dirs), 1)) * (cell_width + GAP) + GAP
+    height = rows * (cell_height + GAP) + GAP
+    sheet = np.full((height, width, 3), 0.15, dtype=np.float32)
+
+    cells = []
+    for index, object_dir in enumerate(object_dirs):
+        images = preview_images(object_dir)
+        checks = {'status': 'missing'}
+        tiles = []
+        for kind in TILE_PASSES:
+            pixels = None
+            if images[kind]:
+                try:
+                    pixels = _rgb(load_image(images[kind]))
+                except (OSError, ValueError):
+                    pixels = None
+            if kind == 'depth' and pixels is not None:
+                checks = depth_checks(pixels[..., 0])
+            tiles.append(_fit(pixels, tile) if pixels is not None else np.zeros((tile, tile, 3), dtype=np.float32))
+
+        row, column = divmod(index, columns)
+        y = GAP + row * (cell_height + GAP)
+        x = GAP + column * (cell_width + GAP)
+        sheet[y:y + cell_height, x:x + cell_width] = np.array(FRAME_COLORS[checks['status']], dtype=np.float32) / 255
+        sheet[y + FRAME:y + FRAME + tile, x + FRAME:x + cell_width - FRAME] = np.concatenate(tiles, axis=1)
+        cells.append(dict(checks, object=os.path.basename(object_dir), row=row, column=column))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    write_png(path, (np.clip(sheet, 0, 1) * 255 + 0.5).astype(np.uint8))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'tiles': TILE_PASSES, 'columns': columns, 'objects': cells}, f, indent=1)
+    return cells
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Contact sheet of the rendered objects in a folder')
+    parser.add_argument('output_folder', type=str, help='folder holding one rendered folder per object')
+    parser.add_argument('-output', type=str, default=None, help='sheet file. Defaults to <output_folder>/contact_sheet.png')
+    parser.add_argument('-columns', type=int, default=4, help='objects per sheet row')
+    parser.add_argument('-tile', type=int, default=128, help='edge of one image tile in pixels')
+    args = parser.parse_args()
+
+    object_dirs = [os.path.join(args.output_folder, name) for name in os.listdir(args.output_folder)
+                   if os.path.isdir(os.path.join(args.output_folder, name, 'obj_rotat0'))]
+    cells = write_contact_sheet(object_dirs, args.output or os.path.join(args.output_folder, 'contact_sheet.png'),
+                                args.columns, args.tile)
+    for cell in cells:
+        if cell['status'] != 'ok':
+            print("{}: {}".format(cell['object'], cell['status']))
@@ -0,0 +1,165 @@
+# Render cost estimates for batch scheduling.
+#
+# The time to render an object is modelled as
+#   seconds = c0 + c1 * images + c2 * faces + c3 * faces * images
+# (blender startup, per image render and write cost, import and cleanup, per image cost of the
+# geometry), with images = views * lights and faces in units of FACE_UNIT triangles. The
+# coefficients start from rough priors and are refitted, as a ridge regression pulled towards the
+# priors, from the durations of completed jobs, which are kept in a JSON file between batches.
+# Jobs that timed out only tell that they take at least their timeout, they are kept as lower bounds.
+# The per image cost depends on resolution, samples, device and so on, so the file keeps one model per
+# render configuration and a batch only fits and uses the one of its own configuration.
+# Face counts are read from the .obj file; where reading it is too expensive (sorting a whole
+# catalogue up front) they are estimated from the file size with a learned bytes per face ratio.
+
+import hashlib
+import json
+import os
+import threading
+
+FACE_UNIT = 10000.0
+PRIOR = [10.0, 2.0, 1.0, 0.1]  # seconds, seconds per image, seconds per FACE_UNIT, seconds per FACE_UNIT and image
+PRIOR_BYTES_PER_FACE = 60.0
+RIDGE = 0.1  # weight of the priors, about a tenth of one completed job per coefficient
+MIN_SAMPLES = 5  # fits from fewer completed jobs are not trusted for timeouts
+MAX_SAMPLES = 1000
+CENSORED_ROUNDS = 3  # refits raising lower bound samples to the prediction
+
+
+# number of vertex and face lines of an .obj file, counted on raw bytes. A hashlib object passed as
+# digest is fed the file on the way, so the content hash needs no second read of the file
+def obj_stats(path, chunk_size=1 << 20, digest=None):
+    vertices = faces = 0
+    tail = b'\n'
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            if digest is not None:
+                digest.update(chunk)
+            data = tail + chunk
+            vertices += data.count(b'\nv ')
+            faces += data.count(b'\nf ')
+            tail = data[-1:]  # a line start split across chunks is still found
+    return vertices, faces
+
+
+def _features(faces, images):
+    units = faces / FACE_UNIT
+    return [1.0, float(images), units, units * images]
+
+
+# solves the small dense system a x = b by gaussian elimination with partial pivoting
+def _solve(a, b):
+    n = len(b)
+    m = [list(row) + [value] for row, value in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(m[row][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            continue
+        for row in range(n):
+            if row != col:
+                factor = m[row][col] / m[col][col]
+                m[row] = [x - factor * y for x, y in zip(m[row], m[col])]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _read_models(path):
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('models', {})  # files without models predate the configurations, not reused
+
+
+class CostModel:
+    # config: JSON serializable render settings the costs depend on
+    def __init__(self, path=None, config=None):
+        self.path = path
+        self.config = config or {}
+        self.key = config_key(self.config)
+        self.coefficients = list(PRIOR)
+        self.samples = []  # [faces, size, images, seconds, lower bound (0 or 1)]
+        self.lock = threading.Lock()
+        state = _read_models(path).get(self.key)
+        if state:
+            self.samples = state['samples'][-MAX_SAMPLES:]
+            self._fit()
+
+    @property
+    def fitted(self):
+        return sum(1 for sample in self.samples if not sample[4]) >= MIN_SAMPLES
+
+    # average .obj bytes per triangle of the objects seen so far
+    def bytes_per_face(self):
+        sizes = sum(sample[1] for sample in self.samples if sample[0] > 0)
+        faces = sum(sample[0] for sample in self.samples if sample[0] > 0)
+        return sizes / faces if faces else PRIOR_BYTES_PER_FACE
+
+    def faces_from_size(self, size):
+        return size / self.bytes_per_face()
+
+    def predict(self, faces, images):
+        with self.lock:
+            seconds = sum(c * x for c, x in zip(self.coefficients, _features(faces, images)))
+        return max(seconds, 1.0)
+
+    # lower_bound: the job did not finish within seconds (timeout)
+    def observe(self, faces, size, images, seconds, lower_bound=False):
+        with self.lock:
+            self.samples.append([faces, size, images, seconds, int(lower_bound)])
+            del self.samples[:-MAX_SAMPLES]
+            self._fit()
+
+    # lower bounds are fitted like durations at the larger of their bound and the current prediction,
+    # so they only pull the model up where it predicts less than the job was seen to take
+    def _fit(self):
+        exact = [sample[:4] for sample in self.samples if not sample[4]]
+        bounds = [sample[:4] for sample in self.samples if sample[4]]
+        self._fit_samples(exact)
+        for _ in range(CENSORED_ROUNDS if bounds else 0):
+            raised = [[faces, size, images, max(seconds, sum(c * x for c, x in zip(self.coefficients, _features(faces, images))))]
+                      for faces, size, images, seconds in bounds]
+            self._fit_samples(exact + raised)
+
+    # ridge regression towards the priors. Coefficients that come out negative are fixed at 0 and the
+    # rest is solved again, as a plain clamp would leave the others compensating for them
+    def _fit_samples(self, samples):
+        n = len(PRIOR)
+        a = [[RIDGE if i == j else 0.0 for j in range(n)] for i in range(n)]
+        b = [RIDGE * prior for prior in PRIOR]
+        for faces, size, images, seconds in samples:
+            x = _features(faces, images)
+            for i in range(n):
+                b[i] += x[i] * seconds
+                for j in range(n):
+                    a[i][j] += x[i] * x[j]
+
+        active = list(range(n))
+        while True:
+            solution = _solve([[a[i][j] for j in active] for i in active], [b[i] for i in active])
+            negative = [i for i, c in zip(active, solution) if c < 0]
+            if not negative:
+                break
+            active = [i for i in active if i not in negative]
+        self.coefficients = [0.0] * n
+        for i, c in zip(active, solution):
+            self.coefficients[i] = c
+
+    # replaces this configuration's model in the file, the others are kept
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            state = {'config': self.config, 'coefficients': self.coefficients, 'samples': self.samples}
+        models = _read_models(self.path)
+        models[self.key] = state
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'models': models}, f)
+        os.replace(tmp_path, self.path)
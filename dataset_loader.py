@@ -0,0 +1,393 @@
+# Reader for datasets rendered with render_blender.py.
+#
+# The output folder is scanned once and a persistent index (photometric_index.json in the
+# dataset root) maps every (object, view, light) sample to its light direction and the files,
+# or packed array offsets, of its passes. Later runs load the index instead of listing
+# directories and parsing file names. Decoded images go through an LRU cache (depth and normal
+# are shared by all lights of a view) and batches can be prefetched by worker processes.
+#
+# Example:
+#   dataset = PhotometricDataset('/data/rendered')
+#   for batch in dataset.iter_batches(32, workers=4):
+#       batch['diffuse'], batch['direction'], ...
+
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import png_io
+from packed_output import PACKED_DIR, INDEX_FILE, VIEW_PASSES
+from light_sampling import read_manifest
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+INDEX_NAME = 'photometric_index.json'
+INDEX_VERSION = 4
+
+COORDS = r'(-?\d+\.\d\d)_(-?\d+\.\d\d)_(-?\d+\.\d\d)'
+LIGHT_FILE = re.compile(r'^(diffuse|specular)' + COORDS + r'\d*\.png$')
+COMBINED_FILE = re.compile(r'^xyz_' + COORDS + r'\d*\.png$')  # light groups wrote a frame suffix before
+VIEW_FILE = re.compile(r'^(depth|normal)\d*\.png$')
+VIEW_DIR = re.compile(r'^obj_rotat(\d+)$')
+
+
+# decode an image file into uint8 / uint16 (H, W, channels). OpenCV and Pillow are used when
+# installed, png_io covers everything else (Pillow drops 16 bit RGB to 8 bit, so it is skipped there)
+def load_image(path):
+    if cv2 is not None:
+        pixels = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if pixels is not None:
+            if pixels.ndim == 2:
+                return pixels[..., None]
+            return np.ascontiguousarray(pixels[..., ::-1])  # BGR(A) -> RGB(A)
+    with open(path, 'rb') as f:
+        data = f.read()
+    bit_depth, color_type = data[24], data[25]
+    if Image is not None and (bit_depth == 8 or color_type == 0):
+        pixels = np.asarray(Image.open(io.BytesIO(data)))
+        return pixels[..., None] if pixels.ndim == 2 else pixels
+    return png_io.decode_png(data)
+
+
+class LRUImageCache:
+    def __init__(self, max_bytes=512 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            if path in self.images:
+                self.images.move_to_end(path)
+                return self.images[path]
+        pixels = load_image(path)
+        pixels.setflags(write=False)  # shared between samples
+        with self.lock:
+            self.images[path] = pixels
+            self.size += pixels.nbytes
+            while self.size > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= evicted.nbytes
+        return pixels
+
+
+# per view crop information of objects rendered with --auto_frame: 'box' is (x0, y0, x1, y1) in
+# full frame pixels, 'frame' the full (width, height) and 'cropped' whether the images only hold the box
+def _read_crops(object_dir):
+    path = os.path.join(object_dir, 'crop.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        crop = json.load(f)
+    return {view['view']: {'box': view['box'], 'frame': crop['resolution'], 'cropped': crop['mode'] == 'crop'}
+            for view in crop['views']}
+
+
+# value of a pass where the object is not: depth maps to the far end, normals to mid gray (the
+# 0.5 * n + 0.5 of a zero normal), everything else is black
+def background_fill(kind, dtype):
+    integer = np.dtype(dtype).kind in 'ui'
+    if kind == 'depth':
+        return np.iinfo(dtype).max if integer else 1.0
+    if kind == 'normal':
+        return np.iinfo(dtype).max // 2 + 1 if integer else 0.5
+    return 0
+
+
+# place a cropped image back into an empty full frame
+def uncrop(pixels, box, frame, fill=0):
+    x0, y0, x1, y1 = box
+    width, height = frame
+    full = np.full((height, width) + pixels.shape[2:], fill, dtype=pixels.dtype)
+    full[y0:y1, x0:x1] = pixels
+    return full
+
+
+# full frame of a pass of a sample rendered with --auto_frame, background outside its box. Cropped images
+# are pasted back, border renders leave the pixels outside the box unrendered: their depth is 0, which
+# the depth mapping turns into "nearest"
+def fill_outside_box(pixels, sample, kind):
+    fill = background_fill(kind, pixels.dtype)
+    if sample.get('cropped'):
+        return uncrop(pixels, sample['box'], sample['frame'], fill)
+    x0, y0, x1, y1 = sample['box']
+    full = np.full(pixels.shape, fill, dtype=pixels.dtype)
+    full[y0:y1, x0:x1] = pixels[y0:y1, x0:x1]
+    return full
+
+
+# index samples of an object rendered as png images in obj_rotat<view>/ folders. Light order and
+# full precision directions come from light_directions.json when the object has one, otherwise
+# from the file names, which only keep 2 decimals
+def _index_png_object(object_dir, object_name):
+    manifest = read_manifest(object_dir)
+    crops = _read_crops(object_dir)
+    samples = []
+    with os.scandir(object_dir) as it:
+        view_dirs = sorted((int(VIEW_DIR.match(entry.name).group(1)), entry.name)
+                           for entry in it if entry.is_dir() and VIEW_DIR.match(entry.name))
+    for view, view_dir in view_dirs:
+        view_files = {}
+        lights = {}  # direction string -> files of the light
+        for name in sorted(os.listdir(os.path.join(object_dir, view_dir))):
+            relative_path = os.path.join(object_name, view_dir, name)
+            match = VIEW_FILE.match(name)
+            if match:
+                view_files[match.group(1)] = relative_path
+                continue
+            match = LIGHT_FILE.match(name)
+            if match:
+                kind, coords = match.group(1), match.group(2, 3, 4)
+            else:
+                match = COMBINED_FILE.match(name)
+                if not match:
+                    continue
+                kind, coords = 'combined', match.group(1, 2, 3)
+            lights.setdefault(coords, {})[kind] = relative_path
+
+        if manifest is not None and view < len(manifest['directions']):
+            directions = manifest['directions'][view]
+            order = [(light, tuple('{:.2f}'.format(c) for c in direction), direction)
+                     for light, direction in enumerate(directions)]
+        else:
+            order = [(light, coords, [float(c) for c in coords]) for light, coords in enumerate(sorted(lights))]
+        for light, coords, direction in order:
+            if coords not in lights:
+                continue  # not rendered (yet)
+            files = dict(view_files)
+            files.update(lights[coords])
+            samples.append(dict({'object': object_name, 'view': view, 'light': light,
+                                 'direction': direction, 'files': files}, **crops.get(view, {})))
+    return samples
+
+
+# index samples of an object rendered with --output_format npy
+def _index_packed_object(object_dir, object_name):
+    with open(os.path.join(object_dir, PACKED_DIR, INDEX_FILE)) as f:
+        index = json.load(f)
+    crops = _read_crops(object_dir)
+    samples = []
+    for view, directions in enumerate(index['lights']):
+        for light, direction in enumerate(directions):
+            samples.append(dict({'object': object_name, 'view': view, 'light': light, 'direction': direction,
+                                 'packed': os.path.join(object_name, PACKED_DIR)}, **crops.get(view, {})))
+    return samples
+
+
+# index samples of an object rendered with --animation, frames.json maps frames to views and lights
+def _index_animation_object(object_dir, object_name):
+    with open(os.path.join(object_dir, 'frames.json')) as f:
+        frames = json.load(f)['frames']
+    samples = []
+    for frame in frames:
+        number = '{:04d}'.format(frame['frame'])
+        names = {kind: kind + number + '.png' for kind in VIEW_PASSES + ['diffuse', 'specular']}
+        names['combined'] = 'xyz_' + number + '.png'
+        files = {kind: os.path.join(object_name, 'frames', name) for kind, name in names.items()
+                 if os.path.isfile(os.path.join(object_dir, 'frames', name))}
+        samples.append({'object': object_name, 'view': frame['view'], 'light': frame['light'],
+                        'direction': frame['direction'], 'files': files})
+    return samples
+
+
+# samples of a single rendered object, None when directory is not an object folder
+def index_object(directory, object_name):
+    if os.path.isfile(os.path.join(directory, PACKED_DIR, INDEX_FILE)):
+        return _index_packed_object(directory, object_name)
+    if os.path.isfile(os.path.join(directory, 'frames.json')):
+        return _index_animation_object(directory, object_name)
+    if os.path.isdir(directory) and any(VIEW_DIR.match(name) for name in os.listdir(directory)):
+        return _index_png_object(directory, object_name)
+    return None
+
+
+def build_index(root):
+    samples = []
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        object_samples = index_object(directory, os.path.relpath(directory, root))
+        if object_samples is None:
+            continue
+        samples += object_samples
+        dirs[:] = []  # nothing to find inside an object folder
+    return {'version': INDEX_VERSION, 'samples': samples}
+
+
+def load_index(root, rebuild=False):
+    index_path = os.path.join(root, INDEX_NAME)
+    if not rebuild and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    index = build_index(root)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+class PhotometricDataset:
+    # passes selects what is loaded per sample, out of depth, normal, diffuse, specular and combined
+    def __init__(self, root, passes=('depth', 'normal', 'diffuse', 'specular'), cache_bytes=512 << 20, rebuild_index=False):
+        self.root = root
+        self.passes = list(passes)
+        self.cache_bytes = cache_bytes
+        self.samples = load_index(root, rebuild_index)['samples']
+        self.cache = LRUImageCache(cache_bytes)
+        self.packed = {}  # packed folder -> read only memory maps, opened on first use
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getstate__(self):
+        # worker processes get their own cache and memory maps
+        state = dict(self.__dict__)
+        state['cache'] = None
+        state['packed'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = LRUImageCache(self.cache_bytes)
+
+    def _packed_arrays(self, packed_dir):
+        if packed_dir not in self.packed:
+            directory = os.path.join(self.root, packed_dir)
+            with open(os.path.join(directory, INDEX_FILE)) as f:
+                index = json.load(f)
+            self.packed[packed_dir] = {kind: np.load(os.path.join(directory, info['file']), mmap_mode='r')
+                                       for kind, info in index['passes'].items()}
+        return self.packed[packed_dir]
+
+    def _load_pass(self, sample, kind):
+        if 'packed' in sample:
+            arrays = self._packed_arrays(sample['packed'])
+            if kind not in arrays:
+                return None
+            pixels = arrays[kind][sample['view']] if kind in VIEW_PASSES else arrays[kind][sample['view'], sample['light']]
+        else:
+            path = sample['files'].get(kind)
+            if path is None:
+                return None
+            pixels = self.cache.get(os.path.join(self.root, path))
+            # same layout as the packed arrays: depth (H, W), everything else (H, W, 3)
+            pixels = pixels[..., 0] if kind == 'depth' else pixels[..., :3]
+        if 'box' in sample:
+            pixels = fill_outside_box(pixels, sample, kind)
+        return pixels
+
+    def __getitem__(self, i):
+        sample = self.samples[i]
+        item = {'object': sample['object'], 'view': sample['view'], 'light': sample['light'],
+                'direction': np.asarray(sample['direction'], dtype=np.float32)}
+        for kind in self.passes:
+            item[kind] = self._load_pass(sample, kind)
+        return item
+
+    # stacked arrays of the given samples. A pass missing for any of them (e.g. specular with light groups) is None
+    def get_batch(self, indices):
+        items = [self[i] for i in indices]
+        batch = {'object': [item['object'] for item in items],
+                 'view': np.array([item['view'] for item in items]),
+                 'light': np.array([item['light'] for item in items]),
+                 'direction': np.stack([item['direction'] for item in items])}
+        for kind in self.passes:
+            values = [item[kind] for item in items]
+            batch[kind] = None if any(value is None for value in values) else np.stack(values)
+        return batch
+
+    # yields batches in (optionally shuffled) order. With workers > 0 batches are loaded by a pool of
+    # processes, at most prefetch batches per worker are requested ahead of the consumer
+    def iter_batches(self, batch_size, shuffle=True, seed=None, workers=0, prefetch=2, drop_last=False):
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+
+        if workers <= 0:
+            for indices in batches:
+                yield self.get_batch(indices)
+            return
+
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            pending = deque()
+            batches = iter(batches)
+            for indices in batches:
+                pending.append(pool.apply_async(_load_batch, (indices,)))
+                if len(pending) >= workers * prefetch:
+                    break
+            while pending:
+                batch = pending.popleft().get()
+                for indices in batches:
+                    pending.append(pool.apply_async(_load_batch, (indices,)))
+                    break
+                yield batch
+
+
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _load_batch(indices):
+    batch = _worker_dataset.get_batch(indices)
+    # memory maps can not be sent back to the parent, copy them into regular arrays
+    for kind, value in batch.items():
+        if isinstance(value, np.memmap):
+            batch[kind] = np.array(value)
+    return batch
+
+
+# samples (up to count) whose served passes do not match their crop: wrong frame size, or depth
+# outside the crop box that is not background
+def check_samples(dataset, count=None):
+    failed = []
+    for i, sample in enumerate(dataset.samples[:count]):
+        if 'box' not in sample:
+            continue
+        x0, y0, x1, y1 = sample['box']
+        width, height = sample['frame']
+        depth = dataset._load_pass(sample, 'depth')
+        if depth is None:
+            continue
+        outside = np.ones(depth.shape, dtype=bool)
+        outside[y0:y1, x0:x1] = False
+        if depth.shape != (height, width) or np.any(depth[outside] != background_fill('depth', depth.dtype)):
+            failed.append(i)
+    return failed
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build (or rebuild) the index of a rendered dataset')
+    parser.add_argument('root', type=str, help='Output folder of render_blender.py / batch_render_blender.py')
+    parser.add_argument('-rebuild', action='store_true', help='scan the folder again even if an index exists')
+    parser.add_argument('-check', type=int, default=None, nargs='?', const=-1,
+                        help='check that the first N samples (all without N) of cropped objects are pasted back correctly')
+    args = parser.parse_args()
+    index = load_index(args.root, args.rebuild)
+    print("{} samples indexed in {}".format(len(index['samples']), os.path.join(args.root, INDEX_NAME)))
+    if args.check is not None:
+        failed = check_samples(PhotometricDataset(args.root), None if args.check < 0 else args.check)
+        print("{} samples failed the crop check{}".format(len(failed), ': {}'.format(failed[:20]) if failed else ''))
@@ -0,0 +1,87 @@
+# Light directions for photometric stereo renders.
+#
+# All views x lights directions of an object are drawn at once from a seeded generator, so a
+# re-render or a resumed run gets exactly the same lights. Directions are unit vectors on the
+# sphere around the object, with theta (the angle to the camera axis, +z) capped at theta_max so
+# the light is never in front of the camera side of the object.
+#
+# Strategies:
+#   uniform     phi and theta drawn uniformly (the original gen_samples_on_shpere_surface distribution)
+#   stratified  per view, phi and theta split into num_of_lights strata each (latin hypercube),
+#               so the lights of a view never cluster
+#   fibonacci   per view, a Fibonacci lattice covering the spherical cap with equal area per
+#               light, randomly rotated around z for every view
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+STRATEGIES = ['uniform', 'stratified', 'fibonacci']
+THETA_MAX = 0.5 * np.pi  # this causes the light not to be directly in front of the camera
+MANIFEST_NAME = 'light_directions.json'
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+# seed of one object, derived from a base seed and a stable object identifier (not python's salted hash)
+def object_seed(base_seed, identifier):
+    digest = hashlib.sha256('{}:{}'.format(base_seed, identifier).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def _to_vectors(phi, theta):
+    return np.stack([np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)], axis=-1)
+
+
+# returns float64 directions of shape (views, num_of_lights, 3)
+def sample_light_directions(views, num_of_lights, seed, strategy='uniform', theta_max=THETA_MAX):
+    rng = np.random.default_rng(seed)
+    shape = (views, num_of_lights)
+
+    if strategy == 'uniform':
+        phi = rng.random(shape) * (2 * np.pi)
+        theta = rng.random(shape) * theta_max
+    elif strategy == 'stratified':
+        strata = np.arange(num_of_lights)
+        phi = (strata + rng.random(shape)) / num_of_lights * (2 * np.pi)
+        theta_strata = rng.permuted(np.broadcast_to(strata, shape), axis=1)
+        theta = (theta_strata + rng.random(shape)) / num_of_lights * theta_max
+    elif strategy == 'fibonacci':
+        k = np.arange(num_of_lights) + 0.5
+        # equal area rings: cos(theta) evenly spaced between 1 and cos(theta_max)
+        cos_theta = 1 - (1 - np.cos(theta_max)) * k / num_of_lights
+        theta = np.broadcast_to(np.arccos(cos_theta), shape)
+        phi = (k * GOLDEN_ANGLE + rng.random((views, 1)) * (2 * np.pi)) % (2 * np.pi)
+    else:
+        raise ValueError("Unknown light sampling strategy {}, expected one of {}".format(strategy, STRATEGIES))
+
+    return _to_vectors(phi, theta)
+
+
+# Loads the directions of an object from its manifest if it was written with the same parameters,
+# otherwise samples them and writes the manifest. The manifest keeps full precision, unlike the
+# file names of the rendered images.
+def object_light_directions(object_dir, views, num_of_lights, seed, strategy='uniform', theta_max=THETA_MAX):
+    params = {'views': views, 'num_of_lights': num_of_lights, 'seed': seed, 'strategy': strategy,
+              'theta_max': theta_max}
+    path = os.path.join(object_dir, MANIFEST_NAME)
+    manifest = read_manifest(object_dir)
+    if manifest is not None and all(manifest.get(key) == value for key, value in params.items()):
+        return np.asarray(manifest['directions'], dtype=np.float64)
+
+    directions = sample_light_directions(views, num_of_lights, seed, strategy, theta_max)
+    os.makedirs(object_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(params, directions=directions.tolist()), f)
+    os.replace(tmp_path, path)
+    return directions
+
+
+def read_manifest(object_dir):
+    path = os.path.join(object_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
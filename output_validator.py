@@ -0,0 +1,272 @@
+# Quality checks of a rendered object, run by the batch driver (-validate) on every object as soon
+# as its render finished, so bad renders are found and rendered again while the batch is running.
+#
+# The object's samples are listed with dataset_loader.index_object() and every view is checked with
+# NumPy statistics over the stack of its images:
+#   missing     no output folder or no samples at all
+#   incomplete  fewer complete samples (every required pass present) than views x lights
+#   corrupt     files that can't be decoded, e.g. PNGs cut short when blender was killed
+#   nan         NaN or infinite values in float outputs
+#   small       the depth map covers (almost) nothing: --scale too small
+#   cut_off     the object touches the image border in most views: --scale too large
+#   too_close   a part of the object is nearer than the 0.7 depth offset, its depth is clipped to 0
+#   flat_depth  the foreground depth spans almost nothing of the range: --depth_scale too small
+#   dark        most combined images are black where the object is, the lights miss it
+#   flat        combined images without any contrast
+#   black_diffuse  the diffuse color pass (DiffCol, independent of the lights) is black on the object:
+#               a material or pass setup problem that rendering again does not fix
+# adjusted_params() maps the problems to changed render parameters for the next attempt.
+# The checks of an object are written to <object>/quality.json.
+#
+# Example:
+# python output_validator.py ./rendered --views 50 -num_of_lights 4
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from dataset_loader import fill_outside_box, index_object, load_image
+from packed_output import open_packed
+
+QUALITY_FILE = 'quality.json'
+BACKGROUND_DEPTH = 1.0 - 1e-3  # mapped depth of pixels that hit nothing
+MIN_COVERAGE = 0.002  # share of the image the object has to cover in the average view
+CUT_OFF_VIEWS = 0.5  # share of views the object may touch the border in
+CLIPPED_FRACTION = 0.05  # share of foreground pixels allowed at depth 0
+MIN_DEPTH_SPAN = 0.02
+DARK_LEVEL = 0.02  # brightest pixel of an image below this is black
+DARK_FRACTION = 0.5  # share of black combined images that flags the lighting
+
+# change of the render parameters per problem: factors for scale and depth_scale, an increment for the seed.
+# Problems without an entry are rendered again with the same parameters
+ADJUSTMENTS = {
+    'small': ('scale', 2.0),
+    'cut_off': ('scale', 0.67),
+    'too_close': ('scale', 0.67),
+    'flat_depth': ('depth_scale', 2.0),
+    'dark': ('seed', 1),
+}
+# problems no other render parameters fix, objects with only these are not rendered again
+NOT_RETRIED = {'black_diffuse'}
+
+
+# passes every sample must have for a set of batch render parameters. Light groups write no
+# specular pass, previews and animations ignore them
+def required_passes(params):
+    passes = ['depth', 'normal', 'diffuse', 'combined']
+    if not params.get('light_groups') or params.get('preview') or params.get('animation'):
+        passes.append('specular')
+    return passes
+
+
+def expected_samples(params):
+    return 1 if params.get('preview') else params['views'] * params['num_of_lights']
+
+
+# images as float in [0, 1] (integer PNGs) or as stored (float arrays)
+def _normalized(pixels):
+    if pixels.dtype.kind in 'ui':
+        return pixels.astype(np.float32) / np.iinfo(pixels.dtype).max
+    return pixels.astype(np.float32, copy=False)
+
+
+class _Loader:
+    def __init__(self, object_dir):
+        self.root = os.path.dirname(object_dir)
+        self.corrupt = []
+        self.packed = None
+
+    # pass of a sample, None when it is missing or can't be decoded. Pixels outside the box of an
+    # --auto_frame sample are background, border renders leave them at depth 0 which reads as nearest
+    def load(self, sample, kind):
+        if 'packed' in sample:
+            if self.packed is None:
+                self.packed = open_packed(os.path.join(self.root, os.path.dirname(sample['packed'])))[1]
+            if kind not in self.packed:
+                return None
+            array = self.packed[kind]
+            pixels = np.asarray(array[sample['view']] if array.ndim < 5 else array[sample['view'], sample['light']])
+        else:
+            path = sample['files'].get(kind)
+            if path is None:
+                return None
+            try:
+                pixels = load_image(os.path.join(self.root, path))
+            except Exception:  # any decoder error means a broken file: zlib, PIL, short reads
+                pixels = None
+            if pixels is None:
+                self.corrupt.append(path)
+                return None
+            pixels = pixels[..., 0] if kind == 'depth' else pixels[..., :3]
+        if 'box' in sample:
+            pixels = fill_outside_box(pixels, sample, kind)
+        return _normalized(pixels)
+
+
+# foreground mask and framing of one mapped depth map in [0, 1], shared with the contact sheets:
+# coverage, whether the object touches the border (edge) and, with a foreground, its depth range and
+# the share of it closer than the 0.7 offset (clipped to 0)
+def depth_stats(depth):
+    foreground = np.isfinite(depth) & (depth < BACKGROUND_DEPTH)
+    stats = {'coverage': float(foreground.mean()),
+             'edge': bool(foreground[[0, -1], :].any() or foreground[:, [0, -1]].any())}
+    if foreground.any():
+        values = depth[foreground]
+        stats['depth_min'], stats['depth_max'] = float(values.min()), float(values.max())
+        stats['depth_span'] = stats['depth_max'] - stats['depth_min']
+        stats['clipped'] = float(np.count_nonzero(values <= 1e-3) / values.size)
+    return foreground, stats
+
+
+# statistics of one view: its depth and normal and the stacked light passes of all its samples
+def _view_stats(depth, normal, diffuse, combined):
+    stats = {'nonfinite': 0}
+    for pixels in [depth, normal, diffuse, combined]:
+        if pixels is not None and pixels.dtype.kind == 'f':
+            stats['nonfinite'] += int(np.count_nonzero(~np.isfinite(pixels)))
+    if depth is None:
+        return stats
+    foreground, framing = depth_stats(depth)
+    stats.update(framing)
+    if foreground.any():
+        # brightest foreground pixel of every light at once, (lights, pixels, 3) -> (lights,)
+        for kind, stack in [('diffuse', diffuse), ('combined', combined)]:
+            if stack is not None and stack.shape[1:3] == depth.shape:
+                stats[kind + '_max'] = np.nan_to_num(stack[:, foreground]).max(axis=(1, 2)).tolist()
+    if combined is not None:
+        flat = combined.reshape(len(combined), -1)
+        stats['combined_range'] = (np.nanmax(flat, axis=1) - np.nanmin(flat, axis=1)).tolist()
+    return stats
+
+
+def _stack(images):
+    images = [image for image in images if image is not None]
+    if not images or any(image.shape != images[0].shape for image in images):
+        return None
+    return np.stack(images)
+
+
+def validate_object(object_dir, params):
+    report = {'expected': expected_samples(params), 'samples': 0, 'complete': 0, 'problems': []}
+    samples = index_object(object_dir, os.path.basename(object_dir)) if os.path.isdir(object_dir) else None
+    if not samples:
+        report['problems'].append('missing')
+        return report
+
+    passes = required_passes(params)
+    loader = _Loader(object_dir)
+    report['samples'] = len(samples)
+    report['complete'] = sum(1 for sample in samples
+                             if 'packed' in sample or all(kind in sample['files'] for kind in passes))
+    views = {}
+    for sample in samples:
+        views.setdefault(sample['view'], []).append(sample)
+
+    view_stats = []
+    for view, view_samples in sorted(views.items()):
+        first = view_samples[0]
+        view_stats.append(_view_stats(
+            loader.load(first, 'depth'), loader.load(first, 'normal'),
+            _stack([loader.load(sample, 'diffuse') for sample in view_samples]),
+            _stack([loader.load(sample, 'combined') for sample in view_samples])))
+
+    problems = report['problems']
+    if report['complete'] < report['expected']:
+        problems.append('incomplete')
+    if loader.corrupt:
+        problems.append('corrupt')
+        report['corrupt_files'] = loader.corrupt
+    report['nonfinite'] = sum(stats['nonfinite'] for stats in view_stats)
+    if report['nonfinite']:
+        problems.append('nan')
+
+    depth_views = [stats for stats in view_stats if 'coverage' in stats]
+    if depth_views:
+        report['coverage'] = float(np.mean([stats['coverage'] for stats in depth_views]))
+        report['edge_views'] = float(np.mean([stats['edge'] for stats in depth_views]))
+        if report['coverage'] < MIN_COVERAGE:
+            problems.append('small')
+        elif report['edge_views'] > CUT_OFF_VIEWS:
+            problems.append('cut_off')
+    spans = [stats['depth_span'] for stats in view_stats if 'depth_span' in stats]
+    if spans:
+        report['depth_span'] = float(np.median(spans))
+        report['depth_clipped'] = float(np.mean([stats['clipped'] for stats in view_stats if 'clipped' in stats]))
+        if report['depth_clipped'] > CLIPPED_FRACTION:
+            problems.append('too_close')
+        elif report['depth_span'] < MIN_DEPTH_SPAN:
+            problems.append('flat_depth')
+    combined_max = np.array([value for stats in view_stats for value in stats.get('combined_max', [])])
+    if combined_max.size:
+        report['dark_fraction'] = float(np.mean(combined_max < DARK_LEVEL))
+        if report['dark_fraction'] > DARK_FRACTION:
+            problems.append('dark')
+    diffuse_max = np.array([value for stats in view_stats for value in stats.get('diffuse_max', [])])
+    if diffuse_max.size and diffuse_max.max() < DARK_LEVEL:
+        problems.append('black_diffuse')
+    ranges = np.array([value for stats in view_stats for value in stats.get('combined_range', [])])
+    if ranges.size:
+        report['combined_range_min'] = float(ranges.min())
+        if ranges.min() < DARK_LEVEL:
+            problems.append('flat')
+    return report
+
+
+def retryable(problems):
+    return any(problem not in NOT_RETRIED for problem in problems)
+
+
+# render parameters of the next attempt at an object with the given problems
+def adjusted_params(params, problems):
+    changes = {}
+    for problem in problems:
+        if problem not in ADJUSTMENTS:
+            continue
+        name, step = ADJUSTMENTS[problem]
+        if name in changes:
+            continue  # too_close after cut_off, the scale is changed once per attempt
+        if name == 'seed':
+            changes[name] = (params.get(name) or 0) + step
+        else:
+            changes[name] = round(params[name] * step, 4)
+    return changes
+
+
+def write_report(object_dir, report):
+    path = os.path.join(object_dir, QUALITY_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check rendered objects for missing, broken or badly framed output')
+    parser.add_argument('output_folder', type=str, help='rendered object folder, or a folder holding several')
+    parser.add_argument('--views', type=int, default=5)
+    parser.add_argument('-num_of_lights', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--depth_scale', type=float, default=1.4)
+    parser.add_argument('--light_groups', action='store_true')
+    parser.add_argument('--preview', action='store_true')
+    parser.add_argument('-write', action='store_true', help='write quality.json into every object folder')
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in ['views', 'num_of_lights', 'scale', 'depth_scale', 'light_groups', 'preview']}
+    if index_object(args.output_folder, '') is not None:
+        object_dirs = [args.output_folder]
+    else:
+        object_dirs = sorted(os.path.join(args.output_folder, name) for name in os.listdir(args.output_folder)
+                             if index_object(os.path.join(args.output_folder, name), name) is not None)
+    failed = 0
+    for object_dir in object_dirs:
+        report = validate_object(object_dir, params)
+        if args.write:
+            write_report(object_dir, report)
+        if report['problems']:
+            failed += 1
+            print("{}: {} {}".format(os.path.basename(object_dir), ', '.join(report['problems']),
+                                     adjusted_params(params, report['problems'])))
+    print("{} of {} objects failed validation".format(failed, len(object_dirs)))
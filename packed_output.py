@@ -0,0 +1,89 @@
+# Packed dataset output: every pass of every view of an object goes into one .npy array
+# per pass instead of thousands of small PNG files.
+#
+# Layout of <object>/packed/:
+#   depth.npy     (views, H, W)             float32 or uint16
+#   normal.npy    (views, H, W, 3)          uint8 or uint16, same encoding as normal.png
+#   diffuse.npy   (views, lights, H, W, 3)  uint8 or uint16
+#   specular.npy  (views, lights, H, W, 3)
+#   combined.npy  (views, lights, H, W, 3)
+#   index.json    shapes and dtypes of the passes, full precision light direction of every (view, light)
+#
+# The arrays are plain .npy files, so readers can np.load(..., mmap_mode='r') them without copying.
+# Only this module and numpy are needed to read them, no blender.
+
+import json
+import os
+
+import numpy as np
+
+PACKED_DIR = 'packed'
+INDEX_FILE = 'index.json'
+VIEW_PASSES = ['depth', 'normal']
+LIGHT_PASSES = ['diffuse', 'specular', 'combined']
+
+
+def quantize(pixels, dtype):
+    maxval = np.iinfo(dtype).max
+    return (np.clip(pixels, 0, 1) * maxval + 0.5).astype(dtype)
+
+
+class PackedWriter:
+    # color_depth is '8' or '16' like the PNG output, depth_dtype 'float32' or 'uint16'
+    def __init__(self, object_dir, views, num_of_lights, color_depth='8', depth_dtype='float32'):
+        self.directory = os.path.join(object_dir, PACKED_DIR)
+        self.views = views
+        self.num_of_lights = num_of_lights
+        self.color_dtype = np.uint16 if str(color_depth) == '16' else np.uint8
+        self.depth_dtype = np.dtype(depth_dtype)
+        self.arrays = {}
+        self.lights = [[None] * num_of_lights for _ in range(views)]
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _array(self, kind, height, width):
+        if kind not in self.arrays:
+            if kind == 'depth':
+                shape, dtype = (self.views, height, width), self.depth_dtype
+            elif kind == 'normal':
+                shape, dtype = (self.views, height, width, 3), self.color_dtype
+            else:
+                shape, dtype = (self.views, self.num_of_lights, height, width, 3), self.color_dtype
+            self.arrays[kind] = np.lib.format.open_memmap(
+                os.path.join(self.directory, kind + '.npy'), mode='w+', dtype=dtype, shape=shape)
+        return self.arrays[kind]
+
+    # pixels are float (H, W, channels) as rendered. light and direction are None for the view passes
+    def write(self, kind, view, light, direction, pixels):
+        height, width = pixels.shape[:2]
+        array = self._array(kind, height, width)
+        if kind == 'depth':
+            depth = pixels[..., 0]
+            array[view] = depth if self.depth_dtype.kind == 'f' else quantize(depth, self.depth_dtype)
+        elif kind == 'normal':
+            array[view] = quantize(pixels[..., :3], self.color_dtype)
+        else:
+            array[view, light] = quantize(pixels[..., :3], self.color_dtype)
+            self.lights[view][light] = [float(c) for c in direction]
+
+    def close(self):
+        passes = {}
+        for kind, array in self.arrays.items():
+            array.flush()
+            passes[kind] = {'file': kind + '.npy', 'shape': list(array.shape), 'dtype': array.dtype.str}
+        self.arrays = {}
+        index = {'views': self.views, 'num_of_lights': self.num_of_lights, 'passes': passes, 'lights': self.lights}
+        # the index is written last, an object without one was not finished
+        tmp_path = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.directory, INDEX_FILE))
+
+
+# read an object's packed output. Returns the index and a dict of read only memory maps per pass
+def open_packed(object_dir):
+    directory = os.path.join(object_dir, PACKED_DIR)
+    with open(os.path.join(directory, INDEX_FILE)) as f:
+        index = json.load(f)
+    arrays = {kind: np.load(os.path.join(directory, info['file']), mmap_mode='r')
+              for kind, info in index['passes'].items()}
+    return index, arrays
@@ -0,0 +1,132 @@
+# Minimal PNG encoder and decoder on top of numpy and zlib, so images can be written from worker
+# threads (zlib releases the GIL while compressing) and read back without blender or an imaging library.
+
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}  # channels -> gray, gray + alpha, RGB, RGBA
+
+
+def _chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+# pixels is a uint8 or uint16 array of shape (H, W) or (H, W, channels), top row first
+def encode_png(pixels, compress_level=6):
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    height, width, channels = pixels.shape
+    if pixels.dtype == np.uint8:
+        bit_depth = 8
+    elif pixels.dtype == np.uint16:
+        bit_depth = 16
+        pixels = pixels.astype('>u2')  # PNG samples are big endian
+    else:
+        raise ValueError("PNG pixels must be uint8 or uint16, got {}".format(pixels.dtype))
+
+    rows = np.ascontiguousarray(pixels).view(np.uint8).reshape(height, -1)
+    # 'Up' filter on every row: difference to the row above, vectorized over the whole image
+    filtered = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, COLOR_TYPES[channels], 0, 0, 0)
+    return (PNG_SIGNATURE + _chunk(b'IHDR', header)
+            + _chunk(b'IDAT', zlib.compress(filtered.tobytes(), compress_level)) + _chunk(b'IEND', b''))
+
+
+def write_png(path, pixels, compress_level=6):
+    data = encode_png(pixels, compress_level)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+# undo the PNG filter of one scanline. Sub and Up are vectorized, Average and Paeth
+# depend on the reconstructed byte to their left and run byte by byte
+def _unfilter(filter_type, line, prior, bpp):
+    if filter_type == 0:
+        return line
+    if filter_type == 1:
+        pixels = line.reshape(-1, bpp)
+        return (np.cumsum(pixels, axis=0, dtype=np.uint64) % 256).astype(np.uint8).reshape(-1)
+    if filter_type == 2:
+        return line + prior
+    out = bytearray(line.tobytes())
+    prior = prior.tobytes()
+    for i in range(len(out)):
+        left = out[i - bpp] if i >= bpp else 0
+        if filter_type == 3:
+            out[i] = (out[i] + ((left + prior[i]) >> 1)) & 0xff
+        else:
+            upper_left = prior[i - bpp] if i >= bpp else 0
+            out[i] = (out[i] + _paeth(left, prior[i], upper_left)) & 0xff
+    return np.frombuffer(bytes(out), dtype=np.uint8)
+
+
+# decode a non interlaced 8 or 16 bit gray / gray + alpha / RGB / RGBA PNG (everything blender writes).
+# Returns uint8 or uint16 pixels of shape (H, W, channels), top row first
+def decode_png(data):
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    position = 8
+    idat = []
+    header = None
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        chunk_type = data[position + 4:position + 8]
+        body = data[position + 8:position + 8 + length]
+        if len(body) != length:
+            raise ValueError("Truncated PNG file")
+        position += 12 + length
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif chunk_type == b'IDAT':
+            idat.append(body)
+        elif chunk_type == b'IEND':
+            break
+    if header is None or not idat:
+        raise ValueError("Truncated PNG file")
+
+    width, height, bit_depth, color_type, _, _, interlace = header
+    channels = {value: key for key, value in COLOR_TYPES.items()}.get(color_type)
+    if channels is None or bit_depth not in (8, 16) or interlace:
+        raise ValueError("Unsupported PNG format (bit depth {}, color type {}, interlace {})".format(
+            bit_depth, color_type, interlace))
+
+    bpp = channels * bit_depth // 8
+    stride = width * bpp
+    try:
+        raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+    except zlib.error as error:
+        raise ValueError("Corrupt PNG image data: {}".format(error))
+    if raw.size < height * (stride + 1):
+        raise ValueError("Truncated PNG image data")
+    raw = raw[:height * (stride + 1)].reshape(height, stride + 1)
+
+    rows = np.empty((height, stride), dtype=np.uint8)
+    prior = np.zeros(stride, dtype=np.uint8)
+    for y in range(height):
+        prior = rows[y] = _unfilter(raw[y, 0], raw[y, 1:], prior, bpp)
+
+    if bit_depth == 16:
+        return rows.view('>u2').astype(np.uint16).reshape(height, width, channels)
+    return rows.reshape(height, width, channels)
+
+
+def read_png(path):
+    with open(path, 'rb') as f:
+        return decode_png(f.read())
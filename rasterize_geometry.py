@@ -0,0 +1,277 @@
+# Blender free depth and normal ground truth.
+#
+# Rasterizes an .obj file with numpy exactly the way render_blender.py sets up the scene:
+#  - the OBJ importer's axis conversion (Y up -> Z up, a 90 degree rotation around X),
+#  - the --scale factor,
+#  - the per view rotation schedule of main_flow (X and Z euler angles grow by 360 / views / 2 degrees per view),
+#  - the camera at (0, 0, 1) looking down -Z, rotated by 90 (radians) around Z, 50mm lens on a 36mm sensor,
+# and writes depth (with the -0.7 offset / depth_scale mapping of the compositor) and world space normals
+# (mapped to 0.5 * n + 0.5) in the same obj_rotat<view>/depth0001.png, normal0001.png layout.
+#
+# Example:
+# python rasterize_geometry.py -obj data/monkey/monkey.obj -output_folder ./gt --views 5
+# python rasterize_geometry.py -obj data/monkey/monkey.obj --views 5 -compare ./rendered/monkey
+
+import argparse
+import os
+from math import radians
+
+import numpy as np
+
+from packed_output import quantize
+from png_io import write_png, read_png
+
+CAMERA_LOCATION = np.array([0.0, 0.0, 1.0])
+CAMERA_ROTATION_Z = 90.0  # setup_camera sets rotation_euler[2] = 90, which blender reads as radians
+LENS = 50.0
+SENSOR_WIDTH = 36.0
+CLIP_START = 0.1
+DEPTH_OFFSET = -0.7
+BACKGROUND_DEPTH = 1e10  # what cycles writes where no object was hit
+EDGE_SPLIT_ANGLE = 0.523
+MAX_CANDIDATES = 1 << 22  # pixel candidates tested at once, bounds the memory of one chunk
+
+
+# vertices (N, 3) and triangles (M, 3) of an .obj file, polygons are fan triangulated
+def load_obj(path):
+    vertices = []
+    faces = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('v '):
+                vertices.append([float(value) for value in line.split()[1:4]])
+            elif line.startswith('f '):
+                indices = [int(corner.split('/')[0]) for corner in line.split()[1:]]
+                # obj indices start at 1, negative ones count back from the last vertex
+                indices = [index - 1 if index > 0 else len(vertices) + index for index in indices]
+                for k in range(1, len(indices) - 1):
+                    faces.append([indices[0], indices[k], indices[k + 1]])
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3), np.array(faces, dtype=np.int64).reshape(-1, 3)
+
+
+def euler_xyz(x, y, z):
+    cx, sx, cy, sy, cz, sz = np.cos(x), np.sin(x), np.cos(y), np.sin(y), np.cos(z), np.sin(z)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rz @ ry @ rx  # blender's XYZ euler applies X first
+
+
+# object to world rotation of a view. The importer leaves the mesh in obj coordinates and sets a
+# 90 degree X rotation on the object, main_flow adds stepsize / 2 to the X and Z angles after every view
+def view_rotation(view, views):
+    step = radians(360.0 / views / 2) * view
+    return euler_xyz(radians(90) + step, 0, step)
+
+
+# world to camera rotation and the tangent of half the field of view
+def camera():
+    world_to_camera = euler_xyz(0, 0, CAMERA_ROTATION_Z).T
+    tan_half_fov = SENSOR_WIDTH / 2 / LENS
+    return world_to_camera, tan_half_fov
+
+
+def face_normals(vertices, faces):
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / np.maximum(length, 1e-20)
+
+
+# per corner normals (M, 3, 3) of smooth shading with auto smooth / edge split: a corner averages
+# the normals of the faces around its vertex that are within split_angle of its own face. Angles
+# don't change under rotation, so this is computed once in object space and rotated per view
+def corner_normals(vertices, faces, split_angle=EDGE_SPLIT_ANGLE):
+    normals = face_normals(vertices, faces)
+    corners = faces.reshape(-1)
+    # group corners by vertex, then pair every corner with every corner of its group
+    order = np.argsort(corners, kind='stable')
+    sorted_vertices = corners[order]
+    starts = np.flatnonzero(np.r_[True, sorted_vertices[1:] != sorted_vertices[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    group_start = np.repeat(starts, sizes)  # per sorted corner
+    group_size = np.repeat(sizes, sizes)
+    rows = np.repeat(np.arange(len(order)), group_size)
+    first_pair = np.repeat(np.cumsum(group_size) - group_size, group_size)
+    cols = np.repeat(group_start, group_size) + np.arange(len(rows)) - first_pair
+    row_normals = normals[order[rows] // 3]
+    col_normals = normals[order[cols] // 3]
+    similar = np.einsum('ij,ij->i', row_normals, col_normals) >= np.cos(split_angle)
+    result = np.zeros((len(corners), 3))
+    np.add.at(result, order[rows[similar]], col_normals[similar])
+    result /= np.maximum(np.linalg.norm(result, axis=1, keepdims=True), 1e-20)
+    return result.reshape(-1, 3, 3)
+
+
+# Z-buffer rasterization of world space triangles. Returns planar depth (H, W) with BACKGROUND_DEPTH
+# where nothing was hit, the index of the visible triangle (-1 for background) and the perspective
+# correct barycentric weights (H, W, 3) of the visible point
+def rasterize(world_vertices, faces, resolution):
+    world_to_camera, tan_half_fov = camera()
+    camera_vertices = (world_vertices - CAMERA_LOCATION) @ world_to_camera.T
+    z = -camera_vertices[:, 2]  # distance in front of the camera along the view axis
+    half = resolution / 2.0
+    x = (camera_vertices[:, 0] / np.maximum(z, 1e-12) / tan_half_fov + 1) * half
+    y = (1 - camera_vertices[:, 1] / np.maximum(z, 1e-12) / tan_half_fov) * half  # rows go down
+
+    visible = (z[faces] > CLIP_START).all(axis=1)
+    triangles = np.flatnonzero(visible)
+    tx, ty, tz = x[faces[triangles]], y[faces[triangles]], z[faces[triangles]]
+
+    # pixel centers inside each triangle's bounding box
+    x0 = np.clip(np.ceil(tx.min(axis=1) - 0.5), 0, resolution).astype(np.int64)
+    x1 = np.clip(np.floor(tx.max(axis=1) - 0.5), -1, resolution - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(ty.min(axis=1) - 0.5), 0, resolution).astype(np.int64)
+    y1 = np.clip(np.floor(ty.max(axis=1) - 0.5), -1, resolution - 1).astype(np.int64)
+    widths = np.maximum(x1 - x0 + 1, 0)
+    counts = widths * np.maximum(y1 - y0 + 1, 0)
+
+    zbuffer = np.full(resolution * resolution, np.inf)
+    triangle_buffer = np.full(resolution * resolution, -1, dtype=np.int64)
+    weight_buffer = np.zeros((resolution * resolution, 3))
+
+    # chunks of triangles with a bounded number of candidate pixels
+    cumulative = np.cumsum(counts)
+    start = 0
+    while start < len(triangles):
+        limit = (cumulative[start - 1] if start else 0) + MAX_CANDIDATES
+        end = max(start + 1, int(np.searchsorted(cumulative, limit, side='right')))
+        chunk = np.arange(start, end)
+        start = end
+        chunk = chunk[counts[chunk] > 0]
+        if not len(chunk):
+            continue
+
+        candidate = np.repeat(chunk, counts[chunk])
+        offsets = np.arange(len(candidate)) - np.repeat(np.cumsum(counts[chunk]) - counts[chunk], counts[chunk])
+        px = x0[candidate] + offsets % widths[candidate]
+        py = y0[candidate] + offsets // widths[candidate]
+        cx, cy = px + 0.5, py + 0.5
+
+        ax, bx, cx_ = tx[candidate, 0], tx[candidate, 1], tx[candidate, 2]
+        ay, by, cy_ = ty[candidate, 0], ty[candidate, 1], ty[candidate, 2]
+        area = (bx - ax) * (cy_ - ay) - (by - ay) * (cx_ - ax)
+        w0 = ((bx - cx) * (cy_ - cy) - (by - cy) * (cx_ - cx)) / np.where(area == 0, 1, area)
+        w1 = ((cx_ - cx) * (ay - cy) - (cy_ - cy) * (ax - cx)) / np.where(area == 0, 1, area)
+        w2 = 1 - w0 - w1
+        inside = (area != 0) & (w0 >= 0) & (w1 >= 0) & (w2 >= 0)  # both windings, cycles renders back faces
+
+        candidate, pixel = candidate[inside], (py * resolution + px)[inside]
+        weights = np.stack([w0[inside], w1[inside], w2[inside]], axis=1) / tz[candidate]
+        inverse_depth = weights.sum(axis=1)
+        depth = 1 / inverse_depth
+        weights /= inverse_depth[:, None]
+
+        # nearest candidate per pixel, then against what earlier chunks left in the buffer
+        order = np.lexsort((depth, pixel))
+        first = np.r_[True, pixel[order][1:] != pixel[order][:-1]]
+        nearest = order[first]
+        closer = depth[nearest] < zbuffer[pixel[nearest]]
+        nearest = nearest[closer]
+        zbuffer[pixel[nearest]] = depth[nearest]
+        triangle_buffer[pixel[nearest]] = triangles[candidate[nearest]]
+        weight_buffer[pixel[nearest]] = weights[nearest]
+
+    zbuffer[np.isinf(zbuffer)] = BACKGROUND_DEPTH
+    shape = (resolution, resolution)
+    return zbuffer.reshape(shape), triangle_buffer.reshape(shape), weight_buffer.reshape(shape + (3,))
+
+
+# distance from the camera position instead of the view plane, for the pixels' view rays
+def radial_depth(planar_depth):
+    resolution = planar_depth.shape[0]
+    _, tan_half_fov = camera()
+    ndc = ((np.arange(resolution) + 0.5) / resolution * 2 - 1) * tan_half_fov
+    ray_length = np.sqrt(1 + ndc[None, :] ** 2 + ndc[:, None] ** 2)
+    return np.where(planar_depth >= BACKGROUND_DEPTH, planar_depth, planar_depth * ray_length)
+
+
+# depth mapped like the compositor's MapValue node (offset -0.7, size depth_scale, min 0) and world space
+# normals mapped like the MixRGB nodes (0.5 * n + 0.5). Both are float images, not yet clipped to [0, 1]
+def render_view(vertices, faces, view, views, resolution=300, scale=1.0, depth_scale=1.4,
+                smooth=False, depth_mode='planar', corners=None):
+    rotation = view_rotation(view, views)
+    world_vertices = (vertices * scale) @ rotation.T
+    depth, triangle, weights = rasterize(world_vertices, faces, resolution)
+    if depth_mode == 'radial':
+        depth = radial_depth(depth)
+    mapped_depth = np.maximum((depth + DEPTH_OFFSET) * depth_scale, 0)
+
+    hit = triangle >= 0
+    normals = np.zeros((resolution, resolution, 3))
+    if smooth:
+        if corners is None:
+            corners = corner_normals(vertices, faces)
+        corner = corners[triangle[hit]] @ rotation.T
+        interpolated = (corner * weights[hit][..., None]).sum(axis=1)
+        normals[hit] = interpolated / np.maximum(np.linalg.norm(interpolated, axis=1, keepdims=True), 1e-20)
+    else:
+        normals[hit] = face_normals(world_vertices, faces)[triangle[hit]]
+    # cycles reports the normal facing the camera for back faces
+    world_to_camera, _ = camera()
+    view_axis = world_to_camera.T @ np.array([0, 0, 1.0])  # from the surface towards the camera
+    flip = (normals @ view_axis) < 0
+    normals[flip] *= -1
+    return mapped_depth, normals * 0.5 + 0.5
+
+
+def to_png_pixels(image, color_depth):
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=2)  # blender writes the depth as RGB gray
+    return quantize(image, np.uint16 if str(color_depth) == '16' else np.uint8)
+
+
+# mean absolute error (in [0, 1] units) and foreground agreement against blender's images of one view
+def compare_view(depth, normal, view_dir, color_depth):
+    maxval = 65535.0 if str(color_depth) == '16' else 255.0
+    blender_depth = read_png(os.path.join(view_dir, 'depth0001.png'))[..., 0] / maxval
+    blender_normal = read_png(os.path.join(view_dir, 'normal0001.png'))[..., :3] / maxval
+    depth, normal = np.clip(depth, 0, 1), np.clip(normal, 0, 1)
+    ours, theirs = depth < 1, blender_depth < 1
+    both = ours & theirs
+    return {
+        'foreground_iou': float((ours & theirs).sum() / max((ours | theirs).sum(), 1)),
+        'depth_mae': float(np.abs(depth - blender_depth)[both].mean()) if both.any() else None,
+        'normal_mae': float(np.abs(normal - blender_normal)[both].mean()) if both.any() else None,
+    }
+
+
+if __name__ == '__main__':
+    import json
+    import time
+
+    parser = argparse.ArgumentParser(description='Rasterize depth and normal maps of an obj file without blender')
+    parser.add_argument('--views', type=int, default=5, help='number of views to be rendered')
+    parser.add_argument('-obj', type=str, help='Path to the obj file to be rendered.')
+    parser.add_argument('-output_folder', type=str, default=None, help='The output path')
+    parser.add_argument('--scale', type=float, default=1, help='Scaling factor applied to model. Depends on size of mesh.')
+    parser.add_argument('--depth_scale', type=float, default=1.4, help='Scaling that is applied to depth. Depends on size of mesh')
+    parser.add_argument('--color_depth', type=str, default='8', help='Number of bit per channel used for output. Either 8 or 16.')
+    parser.add_argument('-resolution', type=int, default=300, help='W,H of final rendered products')
+    parser.add_argument('--smooth', action='store_true', help='Smooth shaded normals (auto smooth at the edge split angle) instead of flat faces')
+    parser.add_argument('--depth_mode', type=str, default='planar', choices=['planar', 'radial'],
+                        help='Depth along the view axis, or distance from the camera as older cycles versions write it')
+    parser.add_argument('-compare', type=str, default=None,
+                        help='Folder with blender renders of this object (containing obj_rotat<i>/) to compare against')
+    args = parser.parse_args()
+
+    vertices, faces = load_obj(args.obj)
+    model_identifier = os.path.split(os.path.split(args.obj)[0])[1]
+    start = time.time()
+    report = []
+    corners = corner_normals(vertices, faces) if args.smooth else None
+    for i in range(args.views):
+        depth, normal = render_view(vertices, faces, i, args.views, args.resolution, args.scale, args.depth_scale,
+                                    args.smooth, args.depth_mode, corners)
+        if args.output_folder:
+            view_dir = os.path.join(args.output_folder, model_identifier, 'obj_rotat' + str(i))
+            os.makedirs(view_dir, exist_ok=True)
+            write_png(os.path.join(view_dir, 'depth0001.png'), to_png_pixels(depth, args.color_depth))
+            write_png(os.path.join(view_dir, 'normal0001.png'), to_png_pixels(normal, args.color_depth))
+        if args.compare:
+            report.append(dict(view=i, **compare_view(depth, normal, os.path.join(args.compare, 'obj_rotat' + str(i)),
+                                                      args.color_depth)))
+    elapsed = time.time() - start
+    print("{} views in {:.3f}s ({:.1f} views/s)".format(args.views, elapsed, args.views / max(elapsed, 1e-9)))
+    if report:
+        print(json.dumps(report, indent=1))
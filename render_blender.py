@@ -7,11 +7,34 @@
 # Update code with blender 3.3.1
 
 from math import radians
+from contextlib import contextmanager
 import argparse
 import sys
 import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import bpy
+import bmesh
+from mathutils import Matrix, Vector
+from bpy_extras.object_utils import world_to_camera_view
+
+# helper modules shipped next to this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from render_manifest import file_digest
+from packed_output import PackedWriter, quantize
+from png_io import write_png
+from light_sampling import STRATEGIES, object_seed, object_light_directions
+from render_timing import PhaseTimer
+from render_telemetry import append_event
+from render_profiles import RENDER_PROFILES, RENDER_PROFILE_KEYS
+
+timer = PhaseTimer()
+timer.add_startup()
 
 
 parser = argparse.ArgumentParser(description='Render object and by-products for use in photometric stereo')
@@ -23,81 +46,214 @@ parser.add_argument('--scale', type=float, default=1, help='Scaling factor appli
 parser.add_argument('--depth_scale', type=float, default=1.4, help='Scaling that is applied to depth. Depends on size of mesh')
 parser.add_argument('--color_depth', type=str, default='8', help='Number of bit per channel used for output. Either 8 or 16.')
 parser.add_argument('-filepath', type=str, help='Path to the output')
+parser.add_argument('-model_id', type=str, default=None,
+                    help='Name of the object\'s folder in -output_folder. Defaults to the name of the folder holding the obj file')
 parser.add_argument('-resolution', type=int, default=300, help='W,H of final rendered products')
+parser.add_argument('--geometry_samples', type=int, default=16,
+                    help='Cycles samples of the per view render that produces depth and normal when there are several lights')
+parser.add_argument('--light_groups', action='store_true',
+                    help='Render all lights of a view at once and split them with light groups (blender 3.2+). No specular output. '
+                         'Each light gets about 1/num_of_lights of the direct light samples, so the images are noisier than per light '
+                         'renders at the same --samples')
+parser.add_argument('--animation', action='store_true',
+                    help='Keyframe all views and lights and render them as one animation job, named by frame number')
+parser.add_argument('--mesh_cache', type=str, default=None,
+                    help='Directory caching cleaned up meshes as .blend files, so reruns skip the obj import and cleanup')
+parser.add_argument('--device', type=str, default='auto', choices=['cpu', 'gpu', 'auto'],
+                    help='Cycles device. auto uses the GPUs if there are any and falls back to the CPU')
+parser.add_argument('--profile', type=str, default=None, choices=sorted(RENDER_PROFILES),
+                    help='Named quality profile setting samples, adaptive threshold, denoiser, tile size, bounces and threads. Default keeps the scene settings')
+parser.add_argument('--samples', type=int, default=None, help='Cycles samples, overrides the profile')
+parser.add_argument('--adaptive_threshold', type=float, default=None, help='Adaptive sampling noise threshold, 0 disables it. Overrides the profile')
+parser.add_argument('--denoiser', type=str, default=None, choices=['NONE', 'OPENIMAGEDENOISE', 'OPTIX'], help='Denoiser, overrides the profile')
+parser.add_argument('--tile_size', type=int, default=None, help='Render tile size in pixels, overrides the profile')
+parser.add_argument('--max_bounces', type=int, default=None, help='Maximum light bounces, overrides the profile')
+parser.add_argument('--threads', type=int, default=None, help='Render threads (0 for all cores), overrides the profile')
+parser.add_argument('--output_format', type=str, default='png', choices=['png', 'npy'],
+                    help='png writes one image per pass, npy packs all views and lights of a pass into one memory mappable array per object')
+parser.add_argument('--packed_depth', type=str, default='float32', choices=['float32', 'uint16'],
+                    help='Depth type of the npy output')
+parser.add_argument('--async_write', type=int, default=0,
+                    help='Number of background threads encoding and writing the PNG images while the next image renders. 0 writes them from the compositor')
+parser.add_argument('--async_queue', type=int, default=None,
+                    help='Maximum number of rendered images waiting to be written before rendering pauses. Defaults to twice --async_write')
+parser.add_argument('--scratch_dir', type=str, default=None,
+                    help='Where raw passes are staged for --async_write and npy output. Defaults to /dev/shm or the temp directory')
+parser.add_argument('--light_sampling', type=str, default='uniform', choices=STRATEGIES,
+                    help='How light directions are spread: uniform in phi and theta, stratified, or a fibonacci lattice')
+parser.add_argument('--seed', type=int, default=0, help='Base seed of the light directions, combined with the object name')
+parser.add_argument('--auto_frame', type=str, default='none', choices=['none', 'border', 'crop'],
+                    help='Only render the pixels the object covers in each view: border keeps full size images, crop writes the cropped region. Boxes go to crop.json')
+parser.add_argument('--timings', type=str, default=None,
+	help='Write the wall clock time spent per phase (import, cleanup, node setup, renders, writes) as JSON to this file')
+parser.add_argument('--telemetry', type=str, default=None,
+	help='Append per view and per light timings to this file (JSON lines), the side channel read by the batch driver')
+parser.add_argument('--preview', action='store_true',
+	help='Quick look at an object: decimated mesh, low resolution and samples, only the first view and light, png output')
+parser.add_argument('--preview_faces', type=int, default=20000, help='Meshes with more faces are decimated to about this many in --preview')
+parser.add_argument('--preview_resolution', type=int, default=128, help='W,H of the images rendered in --preview')
+parser.add_argument('--preview_samples', type=int, default=8, help='Cycles samples in --preview, unless --samples is given')
+parser.add_argument('-server', action='store_true', help='Keep running and read render jobs (one JSON object per line) from stdin')
 
 
 argv = sys.argv
 argv = argv[argv.index("--") + 1:]  # parse only string after '--'
 args = parser.parse_args(argv)
 
+# a preview renders the first view and light of the full settings, so framing and light match the full render
+if args.preview:
+	args.resolution = args.preview_resolution
+	if args.samples is None:
+		args.samples = args.preview_samples
+	args.geometry_samples = min(args.geometry_samples, args.preview_samples)
+
 print('args: ', args)
 
-# generate a point on a sphere with radius 1, not in front of the cam
-def gen_samples_on_shpere_surface():
-	factor = 0.5  # this causes the light not to be directly in front of the camera
-	r = 1
-	phi_ = np.random.random() * (2 * np.pi)  # angle in xy plane
-	theta_ = np.random.random() * (factor * np.pi)  # angle from z angle
-	x = r * np.cos(phi_) * np.sin(theta_)
-	y = r * np.sin(phi_) * np.sin(theta_)
-	z = r * np.cos(theta_)
-	return x, y, z
+LIGHT_ENERGY = 0.1
+EDGE_SPLIT_ANGLE = 0.523
 
+# (views, num_of_lights, 3) light directions of the current object, points on a sphere with radius 1,
+# not in front of the cam. Seeded per object and kept in <filepath>/light_directions.json, so
+# re-rendering an object uses the same lights
+def get_light_directions():
+	seed = object_seed(args.seed, os.path.basename(args.filepath))
+	return object_light_directions(args.filepath, args.views, args.num_of_lights, seed, args.light_sampling)
 
-def load_object(obj_filename):
-	bpy.ops.import_scene.obj(filepath=obj_filename)
-	for object in bpy.context.scene.objects:
-		if object.name in ['Camera', 'Lamp']:
-			continue
-		bpy.context.view_layer.objects.active = object
-
-		# object = bpy.context.active_object
-		object.select_set(True)
-		if args.scale != 1:
-			bpy.ops.transform.resize(value=(args.scale, args.scale, args.scale))
-			bpy.ops.object.transform_apply(scale=True)
-
-		# remove double meshes FIXME
-		bpy.ops.object.editmode_toggle()
-		bpy.ops.mesh.remove_doubles()
-		bpy.ops.object.editmode_toggle()
-
-
-		# split edges for better quality
-		bpy.ops.object.modifier_add(type='EDGE_SPLIT')
-		bpy.context.object.modifiers["EdgeSplit"].split_angle = 0.523
-		bpy.context.object.modifiers["EdgeSplit"].use_edge_angle = True
-		bpy.context.object.modifiers["EdgeSplit"].use_edge_sharp = False
-		if bpy.app.version >= (2, 91, 0):
-			bpy.ops.object.modifier_apply(modifier="EdgeSplit")
-		else:
-			bpy.ops.object.modifier_apply(apply_as='DATA', modifier="EdgeSplit")
 
-		# bpy.ops.object.modifier_add(type='SUBSURF')
-		# bpy.context.object.modifiers["Subdivision"].levels = 3
-		# bpy.context.object.modifiers["Subdivision"].render_levels = 3
-		# bpy.context.object.modifiers["Subdivision"].subdivision_type = 'CATMULL_CLARK'
-		
-		bpy.context.object.data.use_auto_smooth = True
-		# bpy.context.object.data.auto_smooth_angle = np.pi/20
+# per view and per light timings for the batch driver, see render_telemetry.py
+def report(event, **fields):
+	if args.telemetry:
+		append_event(args.telemetry, event, **fields)
 
 
+# import the obj file and clean up its meshes. Returns the imported objects.
+# Only the import itself is an operator, the cleanup works on the mesh data directly
+def import_object(obj_filename):
+	with timer.phase('import'):
+		bpy.ops.import_scene.obj(filepath=obj_filename)
+	objects = [object for object in bpy.context.scene.objects if object.type == 'MESH']
+	with timer.phase('mesh_cleanup'):
+		for object in objects:
+			cleanup_mesh(object.data)
+	return objects
 
-def setup_nodes():
-	# Delete previous stuff
-	for obj in bpy.data.objects:
+
+def cleanup_mesh(mesh):
+
+	if args.scale != 1:
+		mesh.transform(Matrix.Scale(args.scale, 4))
+
+	bm = bmesh.new()
+	bm.from_mesh(mesh)
+
+	# remove double meshes FIXME
+	bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.0001)
+
+	# split edges for better quality, same as an EdgeSplit modifier using the edge angle only
+	sharp_edges = [edge for edge in bm.edges
+		if len(edge.link_faces) == 2 and edge.calc_face_angle(0) > EDGE_SPLIT_ANGLE]
+	bmesh.ops.split_edges(bm, edges=sharp_edges)
+
+	bm.to_mesh(mesh)
+	bm.free()
+	mesh.update()
+
+	# bpy.ops.object.modifier_add(type='SUBSURF')
+	# bpy.context.object.modifiers["Subdivision"].levels = 3
+	# bpy.context.object.modifiers["Subdivision"].render_levels = 3
+	# bpy.context.object.modifiers["Subdivision"].subdivision_type = 'CATMULL_CLARK'
+	
+	mesh.use_auto_smooth = True
+	# mesh.auto_smooth_angle = np.pi/20
+
+
+# cleaned meshes are cached as .blend files named by the hash of everything that goes into them:
+# the obj content, the scale and the edge split angle
+def mesh_cache_path(obj_filename):
+	key = json.dumps({'obj': file_digest(obj_filename), 'scale': args.scale, 'split_angle': EDGE_SPLIT_ANGLE}, sort_keys=True)
+	return os.path.join(args.mesh_cache, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.blend')
+
+
+def load_cached_object(cache_path):
+	with bpy.data.libraries.load(cache_path) as (data_from, data_to):
+		data_to.objects = data_from.objects
+	for object in data_to.objects:
+		bpy.context.scene.collection.objects.link(object)
+
+
+def save_cached_object(cache_path, objects):
+	os.makedirs(args.mesh_cache, exist_ok=True)
+	# write under a private name and rename, other workers may be reading the cache at the same time
+	tmp_path = '{}.{}.tmp.blend'.format(cache_path[:-len('.blend')], os.getpid())
+	bpy.data.libraries.write(tmp_path, set(objects))
+	os.replace(tmp_path, cache_path)
+
+
+def load_object(obj_filename):
+	if not args.mesh_cache:
+		import_object(obj_filename)
+	else:
+		cache_path = mesh_cache_path(obj_filename)
+		if os.path.isfile(cache_path):
+			print("Loading cached mesh {}".format(cache_path))
+			with timer.phase('mesh_cache_load'):
+				load_cached_object(cache_path)
+		else:
+			objects = import_object(obj_filename)
+			with timer.phase('mesh_cache_save'):
+				save_cached_object(cache_path, objects)
+
+	# after the cache, so it keeps the full resolution meshes
+	if args.preview:
+		with timer.phase('decimate'):
+			decimate_meshes([object for object in bpy.context.scene.objects if object.type == 'MESH'])
+
+
+# collapse meshes with more than --preview_faces faces down to about that many, the decimated
+# mesh replaces the object's mesh
+def decimate_meshes(objects):
+	faces = sum(len(object.data.polygons) for object in objects)
+	if faces <= args.preview_faces:
+		return
+	ratio = args.preview_faces / float(faces)
+	print("Decimating {} faces to {:.0f}".format(faces, faces * ratio))
+	depsgraph = bpy.context.evaluated_depsgraph_get()
+	for object in objects:
+		modifier = object.modifiers.new(name='PreviewDecimate', type='DECIMATE')
+		modifier.decimate_type = 'COLLAPSE'
+		modifier.ratio = ratio
+		modifier.use_collapse_triangulate = True
+		depsgraph.update()
+		mesh = bpy.data.meshes.new_from_object(object.evaluated_get(depsgraph))
+		object.modifiers.remove(modifier)
+		old_mesh, object.data = object.data, mesh
+		mesh.use_auto_smooth = old_mesh.use_auto_smooth
+		if old_mesh.users == 0:
+			bpy.data.meshes.remove(old_mesh)
+
+
+
+# delete every object except the camera, and drop the datablocks they leave behind
+def clear_scene():
+	for obj in list(bpy.data.objects):
 		if obj.name in ['Camera']:
 			continue
-		obj.select_set(True)
-		bpy.ops.object.delete()
+		bpy.data.objects.remove(obj, do_unlink=True)
 
-	# Set up rendering of depth map.
-	bpy.context.scene.use_nodes = True
-	tree = bpy.context.scene.node_tree
-	links = tree.links
+	# in dependency order: materials use textures and images, textures use images
+	for collection in [bpy.data.meshes, bpy.data.materials, bpy.data.textures, bpy.data.images, bpy.data.lights, bpy.data.actions]:
+		for datablock in list(collection):
+			if datablock.users == 0 and not is_render_image(datablock):
+				collection.remove(datablock)
 
-	bpy.context.scene.render.engine = 'CYCLES'
-	bpy.context.scene.cycles.device = 'GPU'
+
+# the render result and viewer images are blender's own, they are kept
+def is_render_image(datablock):
+	return isinstance(datablock, bpy.types.Image) and datablock.type in ('RENDER_RESULT', 'COMPOSITING')
+
+
+# enable all GPUs for cycles, returns False if there are none
+def setup_gpus():
 	preferences = bpy.context.preferences
 	cycles_preferences = preferences.addons['cycles'].preferences
 	cycles_preferences.compute_device_type = 'CUDA'
@@ -110,9 +266,9 @@ def setup_nodes():
 		cuda_devices = cycles_preferences.devices
 		opencl_devices = cycles_preferences.devices
 
-	if not cuda_devices or cuda_devices == []:
+	if not cuda_devices or not [device for device in cuda_devices if device.type != 'CPU']:
 		print(cuda_devices)
-		raise RuntimeError("NO GPUs found")
+		return False
 
 	for device in cuda_devices:
 		if device.type == 'CPU':
@@ -120,6 +276,71 @@ def setup_nodes():
 		else:
 			print(f'Activating {device.name}')
 			device.use = True
+	return True
+
+
+def setup_device():
+	scene = bpy.context.scene
+	if args.device in ['gpu', 'auto']:
+		if setup_gpus():
+			scene.cycles.device = 'GPU'
+			return
+		if args.device == 'gpu':
+			raise RuntimeError("NO GPUs found")
+		print("No GPU found, rendering on the CPU")
+	scene.cycles.device = 'CPU'
+
+
+# cycles settings of a profile, explicit command line values win over the profile
+def render_settings():
+	settings = dict(RENDER_PROFILES[args.profile]) if args.profile else {}
+	for key in RENDER_PROFILE_KEYS:
+		if getattr(args, key) is not None:
+			settings[key] = getattr(args, key)
+	return settings
+
+
+def apply_render_profile():
+	scene = bpy.context.scene
+	cycles = scene.cycles
+	render = scene.render
+	settings = render_settings()
+	print('render settings: ', settings)
+
+	if 'samples' in settings:
+		cycles.samples = settings['samples']
+	if 'adaptive_threshold' in settings and hasattr(cycles, 'use_adaptive_sampling'):  # blender 2.83+
+		cycles.use_adaptive_sampling = settings['adaptive_threshold'] > 0
+		cycles.adaptive_threshold = settings['adaptive_threshold']
+	if 'denoiser' in settings and hasattr(cycles, 'denoiser'):  # blender 2.90+
+		cycles.use_denoising = settings['denoiser'] != 'NONE'
+		if settings['denoiser'] != 'NONE':
+			cycles.denoiser = settings['denoiser']
+	if 'tile_size' in settings:
+		if hasattr(cycles, 'tile_size'):  # blender 3.0+
+			cycles.use_auto_tile = True
+			cycles.tile_size = settings['tile_size']
+		else:
+			render.tile_x = render.tile_y = settings['tile_size']
+	if 'max_bounces' in settings:
+		cycles.max_bounces = settings['max_bounces']
+	if settings.get('threads'):
+		render.threads_mode = 'FIXED'
+		render.threads = min(settings['threads'], os.cpu_count() or 1)
+
+
+def setup_nodes():
+	# Delete previous stuff
+	clear_scene()
+
+	# Set up rendering of depth map.
+	bpy.context.scene.use_nodes = True
+	tree = bpy.context.scene.node_tree
+	links = tree.links
+
+	bpy.context.scene.render.engine = 'CYCLES'
+	setup_device()
+	apply_render_profile()
 
 	render = bpy.context.scene.render
 	render.image_settings.file_format = "PNG"
@@ -181,8 +402,6 @@ def setup_nodes():
 	links.new(render_layers.outputs['GlossDir'], specular_file_output.inputs[0]) # GlossCol / GlossDir / GlossInd
 
 	scene = bpy.context.scene
-	model_identifier = os.path.split(os.path.split(args.obj)[0])[1]
-	args.filepath = os.path.join(args.output_folder, model_identifier)
 	scene.render.image_settings.file_format = 'PNG'  # set output format to .png
 
 	stepsize = 360.0 / args.views
@@ -209,59 +428,592 @@ def setup_camera():
 	cam.rotation_euler[1] = 0
 
 
-def main_flow():
-	normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = setup_nodes()
-	setup_camera()
-	load_object(args.obj)
+# pixel box (x0, y0, x1, y1), top left origin and exclusive end, that contains the objects in the
+# current view. Uses the 8 corners of each object's bounding box, so it is conservative but cheap.
+# An obj file can import as several mesh objects (one per group), the box holds all of them
+def object_pixel_box(objects, margin=2):
+	scene = bpy.context.scene
+	cam = scene.objects['Camera']
+	bpy.context.view_layer.update()  # matrix_world has to follow the rotation of the view
+	corners = [world_to_camera_view(scene, cam, objct.matrix_world @ Vector(corner))
+		for objct in objects for corner in objct.bound_box]
+	width, height = scene.render.resolution_x, scene.render.resolution_y
+	if not corners or any(corner.z <= 0 for corner in corners):
+		return 0, 0, width, height  # part of the object is behind the camera, keep the whole frame
+
+	ndc = np.array([(corner.x, corner.y) for corner in corners])
+	x0 = int(np.clip(np.floor(ndc[:, 0].min() * width) - margin, 0, width))
+	x1 = int(np.clip(np.ceil(ndc[:, 0].max() * width) + margin, 0, width))
+	# camera view y points up, image rows go down
+	y0 = int(np.clip(np.floor((1 - ndc[:, 1].max()) * height) - margin, 0, height))
+	y1 = int(np.clip(np.ceil((1 - ndc[:, 1].min()) * height) + margin, 0, height))
+	if x1 <= x0 or y1 <= y0:
+		return 0, 0, width, height
+	return x0, y0, x1, y1
+
+
+# restrict rendering to the region the object covers. 'border' renders only that region of the full
+# frame (the rest stays empty), 'crop' also crops the images to it. The camera does not move, so depth is unchanged
+def set_render_border(box):
+	render = bpy.context.scene.render
+	x0, y0, x1, y1 = box
+	width, height = render.resolution_x, render.resolution_y
+	render.border_min_x = x0 / width
+	render.border_max_x = x1 / width
+	render.border_min_y = 1 - y1 / height
+	render.border_max_y = 1 - y0 / height
+	render.use_border = True
+	render.use_crop_to_border = args.auto_frame == 'crop'
 
-	stepsize = 360.0 / args.views
+
+def clear_render_border():
+	render = bpy.context.scene.render
+	render.use_border = False
+	render.use_crop_to_border = False
+
+
+# crop.json tells loaders where every view's images sit in the full frame
+def write_crop_manifest(boxes):
+	render = bpy.context.scene.render
+	crop = {'mode': args.auto_frame, 'resolution': [render.resolution_x, render.resolution_y],
+		'views': [{'view': view, 'box': list(box)} for view, box in enumerate(boxes)]}
+	os.makedirs(args.filepath, exist_ok=True)
+	with open(os.path.join(args.filepath, 'crop.json'), 'w') as f:
+		json.dump(crop, f, indent=1)
+
+
+# one point light per light group, all placed at once so a single render covers every light of a view.
+# Returns the lights and a file output node with one slot per light for the combined and diffuse passes
+def setup_light_groups(num_of_lights):
 	scene = bpy.context.scene
-	num_of_lights = args.num_of_lights
+	view_layer = scene.view_layers["ViewLayer"]
+	tree = scene.node_tree
+	render_layers = next(node for node in tree.nodes if node.type == 'R_LAYERS')
+
+	lights = []
+	for jj in range(num_of_lights):
+		name = 'light{}'.format(jj)
+		if name not in view_layer.lightgroups:
+			view_layer.lightgroups.add(name=name)
+		light = new_point_light(name)
+		light.lightgroup = name
+		lights.append(light)
+
+	combined_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+	combined_file_output.label = 'Light Group Combined Output'
+	combined_file_output.format.file_format = "PNG"
+	combined_file_output.format.color_depth = args.color_depth
+	combined_file_output.format.color_mode = "RGB"
+	diffuse_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+	diffuse_file_output.label = 'Light Group Diffuse Output'
+	for output_node in [combined_file_output, diffuse_file_output]:
+		output_node.base_path = ''
+		for jj in range(1, num_of_lights):
+			output_node.file_slots.new('light{}'.format(jj))
 
-	light_directions = {}  # saved and will be written to file
+	for jj in range(num_of_lights):
+		combined_pass = render_layers.outputs.get('Combined_light{}'.format(jj))
+		if combined_pass is None:
+			raise RuntimeError("Render layer has no pass for light group light{}".format(jj))
+		tree.links.new(combined_pass, combined_file_output.inputs[jj])
+		# the diffuse color pass does not depend on the light, every light gets a copy under its own name
+		tree.links.new(render_layers.outputs['DiffCol'], diffuse_file_output.inputs[jj])
 
-	for i in range(0, args.views):
-		
-		print("Rotation {}, {}".format((stepsize * i), radians(stepsize * i)))
-		file_path  = os.path.join(args.filepath, "obj_rotat" + str(i), "")
+	return lights, combined_file_output, diffuse_file_output
 
-		depth_file_output.file_slots[0].path = file_path + "depth"
-		normal_file_output.file_slots[0].path = file_path + "normal"
 
-		for jj in range(num_of_lights):
-			x, y, z = gen_samples_on_shpere_surface()
-			scene.render.filepath = file_path + 'xyz_{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
-			diffuse_file_output.file_slots[0].path = file_path + "diffuse" + '{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
-			specular_file_output.file_slots[0].path = file_path + "specular" + '{:.2f}_{:.2f}_{:.2f}'.format(x, y, z) 
+def remove_light_groups(lights, light_group_nodes):
+	tree = bpy.context.scene.node_tree
+	for node in light_group_nodes:
+		tree.nodes.remove(node)
+	for light in lights:
+		remove_light(light)
+
+
+# mute the given output nodes for the duration of a with block
+@contextmanager
+def muted(*output_nodes):
+	for node in output_nodes:
+		node.mute = True
+	try:
+		yield
+	finally:
+		for node in output_nodes:
+			node.mute = False
+
+
+# path of the image a file output node writes for the current frame
+def output_node_file(slot_path, extension):
+	frame = bpy.context.scene.frame_current
+	if '#' in slot_path:
+		digits = slot_path.count('#')
+		return slot_path.replace('#' * digits, str(frame).zfill(digits), 1) + extension
+	return slot_path + '{:04d}'.format(frame) + extension
+
+
+# float (H, W, 4) pixels of an image file, top row first
+def read_image_pixels(path):
+	image = bpy.data.images.load(path, check_existing=False)
+	try:
+		width, height = image.size
+		if bpy.app.version >= (2, 83, 0):
+			pixels = np.empty(width * height * 4, dtype=np.float32)
+			image.pixels.foreach_get(pixels)
+		else:
+			pixels = np.array(image.pixels[:], dtype=np.float32)
+		return pixels.reshape(height, width, 4)[::-1]  # blender stores the bottom row first
+	finally:
+		bpy.data.images.remove(image)
+
+
+# Renders with the file output nodes redirected to uncompressed float EXR files in a scratch
+# directory, reads the passes back as numpy arrays and hands them to a writer, which decides how
+# they are stored. The writer gets (kind, view, light, direction, target, pixels), where target is
+# the PNG path (without frame number and extension) the pass would have been written to.
+class PassCapture:
+	def __init__(self, output_nodes, writer, scratch_dir):
+		normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = output_nodes
+		self.writer = writer
+		self.scratch_dir = scratch_dir
+		os.makedirs(scratch_dir, exist_ok=True)
+
+		# the combined image normally comes from write_still, here it needs its own output node
+		tree = bpy.context.scene.node_tree
+		render_layers = next(node for node in tree.nodes if node.type == 'R_LAYERS')
+		self.combined_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+		self.combined_file_output.label = 'Combined Output'
+		self.combined_file_output.base_path = ''
+		tree.links.new(render_layers.outputs['Image'], self.combined_file_output.inputs[0])
+
+		self.nodes = {'depth': depth_file_output, 'normal': normal_file_output, 'diffuse': diffuse_file_output,
+			'specular': specular_file_output, 'combined': self.combined_file_output}
+		self.formats = {}
+		for node in self.nodes.values():
+			self.formats[node] = (node.format.file_format, node.format.color_depth, node.format.color_mode)
+			node.format.file_format = 'OPEN_EXR'
+			node.format.color_depth = '32'
+			node.format.color_mode = 'RGB'
+			node.format.exr_codec = 'NONE'
+
+	# render once and pass every unmuted output to the writer. light is None for the geometry render
+	def render(self, view, light=None, direction=None):
+		scene = bpy.context.scene
+		self.combined_file_output.mute = light is None
+		self.combined_file_output.file_slots[0].path = scene.render.filepath
+		targets = {}
+		for kind, node in self.nodes.items():
+			if node.mute:
+				continue
+			targets[kind] = node.file_slots[0].path
+			node.file_slots[0].path = os.path.join(self.scratch_dir, kind)
+
+		bpy.ops.render.render()
+
+		for kind, target in targets.items():
+			node = self.nodes[kind]
+			scratch_file = output_node_file(node.file_slots[0].path, '.exr')
+			node.file_slots[0].path = target
+			with timer.phase('capture_read'):
+				pixels = read_image_pixels(scratch_file)
+				os.remove(scratch_file)
+			with timer.phase('write'):
+				self.writer.write(kind, view, light, direction, target, pixels)
+
+	# restores the output nodes. The writer is closed by the caller once every view rendered
+	def close(self):
+		for node, (file_format, color_depth, color_mode) in self.formats.items():
+			node.format.file_format = file_format
+			node.format.color_depth = color_depth
+			node.format.color_mode = color_mode
+		bpy.context.scene.node_tree.nodes.remove(self.combined_file_output)
+		try:
+			os.rmdir(self.scratch_dir)
+		except OSError:
+			pass
+
+
+# adapts a PackedWriter to the PassCapture writer interface, the target file names are not needed
+class PackedCaptureWriter:
+	def __init__(self, packed_writer):
+		self.packed_writer = packed_writer
+
+	def write(self, kind, view, light, direction, target, pixels):
+		self.packed_writer.write(kind, view, light, direction, pixels)
+
+	def close(self):
+		self.packed_writer.close()
+
+
+# directory for the raw EXR files of a PassCapture. They are several times the size of the PNGs and
+# only live until they are read back, so they stay on the local machine: /dev/shm when there is one,
+# else the temp directory. --scratch_dir overrides it
+def scratch_path():
+	scratch_dir = args.scratch_dir
+	if not scratch_dir:
+		scratch_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+	return os.path.join(scratch_dir, 'render_scratch_{}_{}'.format(os.path.basename(args.filepath), os.getpid()))
+
+
+# Encodes and writes captured passes as PNG on a pool of background threads, so cycles can start
+# the next render while the previous one is compressed. At most max_pending images wait for a
+# thread, after that write() blocks the render loop, which caps the memory held by the queue.
+class AsyncPngWriter:
+	def __init__(self, threads, max_pending, color_depth, compression):
+		self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='png_writer')
+		self.slots = threading.BoundedSemaphore(max_pending)
+		self.dtype = np.uint16 if str(color_depth) == '16' else np.uint8
+		self.compress_level = int(round(compression * 9 / 100.0))
+		self.futures = []
+
+	def write(self, kind, view, light, direction, target, pixels):
+		# write_still names the combined image without frame number, the file output nodes add one
+		path = target + '.png' if kind == 'combined' else output_node_file(target, '.png')
+		self.slots.acquire()
+		try:
+			future = self.pool.submit(self._write, path, pixels)
+		except Exception:
+			self.slots.release()
+			raise
+		future.add_done_callback(lambda _: self.slots.release())
+		self.futures.append(future)
+
+	def _write(self, path, pixels):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		write_png(path, quantize(pixels[..., :3], self.dtype), self.compress_level)
+
+	# waits for every pending image, raises the first error of a background write
+	def close(self):
+		self.pool.shutdown(wait=True)
+		futures, self.futures = self.futures, []
+		for future in futures:
+			future.result()
+
+
+# depth and normal only depend on the geometry, render them once per view with a small sample count
+def render_view_geometry(output_nodes, view, capture=None):
+	normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = output_nodes
+	scene = bpy.context.scene
+	samples = scene.cycles.samples
+	scene.cycles.samples = args.geometry_samples
+	try:
+		with muted(diffuse_file_output, specular_file_output), timer.phase('render_geometry'):
+			if capture:
+				capture.render(view)
+			else:
+				bpy.ops.render.render()
+	finally:
+		scene.cycles.samples = samples
+
+
+# render every light of the current view separately, only the lighting dependent outputs are written.
+# The same light object is moved from position to position. A separate geometry render only pays off
+# with several lights, a single light render writes depth and normal as well
+def render_view_per_light(file_path, output_nodes, light, view, directions, capture=None):
+	normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = output_nodes
+	scene = bpy.context.scene
+
+	if len(directions) == 1:
+		render_light(scene, file_path, diffuse_file_output, specular_file_output, light, view, 0, directions[0], capture)
+		return
+	render_view_geometry(output_nodes, view, capture)
+	with muted(depth_file_output, normal_file_output):
+		for jj, direction in enumerate(directions):
+			render_light(scene, file_path, diffuse_file_output, specular_file_output, light, view, jj, direction, capture)
 
-			# create new point light
-			bpy.ops.object.light_add(type='POINT', location=(0, 0, 0))  # was  0 0 0
-			light = bpy.data.lights['Point']
-			light.energy = 0.1
 
-			bpy.data.objects['Point'].select_set(True)
-			bpy.ops.transform.translate(value=(x, y, z))
+# render a single light placed at direction
+def render_light(scene, file_path, diffuse_file_output, specular_file_output, light, view, jj, direction, capture=None):
+	x, y, z = direction
+	scene.render.filepath = file_path + 'xyz_{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
+	diffuse_file_output.file_slots[0].path = file_path + "diffuse" + '{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
+	specular_file_output.file_slots[0].path = file_path + "specular" + '{:.2f}_{:.2f}_{:.2f}'.format(x, y, z) 
 
+	light.location = (x, y, z)
+
+	start = time.time()
+	with timer.phase('render_light'):
+		if capture:
+			capture.render(view, jj, (x, y, z))
+		else:
 			bpy.ops.render.render(write_still=True)  # render still
+	report('light', view=view, light=jj, seconds=time.time() - start)
 
-			# delete light
-			bpy.data.objects['Point'].select_set(True)
-			bpy.ops.object.delete()
 
-		for obj in bpy.data.objects:
-			if obj.name in ['Point', 'Camera']:
-				continue
+# render all lights of the current view in one pass, each light is split out through its light group.
+# Cycles has no per light group specular pass, so no specular images are written in this mode.
+# Direct lighting picks one of the M lights per sample, so each light group only gets about 1/M of
+# the samples: at the same sample count its images are noisier than a render of that light alone
+def render_view_light_groups(file_path, lights, light_group_nodes, directions):
+	combined_file_output, diffuse_file_output = light_group_nodes
+
+	for jj, light in enumerate(lights):
+		x, y, z = directions[jj]
+		light.location = (x, y, z)
+		combined_file_output.file_slots[jj].path = file_path + 'xyz_{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
+		diffuse_file_output.file_slots[jj].path = file_path + "diffuse" + '{:.2f}_{:.2f}_{:.2f}'.format(x, y, z)
+
+	with timer.phase('render_light_groups'):
+		bpy.ops.render.render()  # the file output nodes write everything, the mixed image is not needed
+
+	# file output nodes add the frame number, the per light renders write the combined image without it
+	for slot in combined_file_output.file_slots:
+		os.replace(output_node_file(slot.path, '.png'), slot.path + '.png')
+
+
+def new_point_light(name):
+	light_data = bpy.data.lights.new(name=name, type='POINT')
+	light_data.energy = LIGHT_ENERGY
+	light = bpy.data.objects.new(name=name, object_data=light_data)
+	bpy.context.scene.collection.objects.link(light)
+	return light
+
+
+def remove_light(light):
+	light_data = light.data
+	bpy.data.objects.remove(light, do_unlink=True)
+	bpy.data.lights.remove(light_data)
+
+
+def use_light_groups():
+	if not args.light_groups:
+		return False
+	if bpy.app.version < (3, 2, 0):
+		print("Light groups need blender 3.2 or newer, rendering every light separately")
+		return False
+	return True
+
+
+def get_mesh_object():
+	for obj in bpy.data.objects:
+		if obj.type != 'MESH':
+			continue
+		else:
+			objct = obj
+	return objct
+
+
+# renders view after view, rotating the object in between
+def render_views(output_nodes):
+	normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = output_nodes
+	stepsize = 360.0 / args.views
+
+	light_directions = get_light_directions()
+	if args.preview:
+		light_directions = light_directions[:1, :1]
+	crop_boxes = []
+
+	light_groups = use_light_groups()
+	capture = None
+	if args.output_format == 'npy':
+		if light_groups:
+			raise ValueError("--output_format npy does not support --light_groups")
+		if args.auto_frame == 'crop':
+			raise ValueError("--output_format npy needs full frames, use --auto_frame border")
+		packed_writer = PackedWriter(args.filepath, args.views, args.num_of_lights, args.color_depth, args.packed_depth)
+		capture = PassCapture(output_nodes, PackedCaptureWriter(packed_writer), scratch_path())
+	elif args.async_write > 0 and light_groups:
+		print("--async_write is ignored with --light_groups")
+	elif args.async_write > 0:
+		compression = bpy.context.scene.render.image_settings.compression
+		writer = AsyncPngWriter(args.async_write, args.async_queue or 2 * args.async_write, args.color_depth, compression)
+		capture = PassCapture(output_nodes, writer, scratch_path())
+
+	if light_groups:
+		lights, combined_file_output, light_group_diffuse_output = setup_light_groups(args.num_of_lights)
+		light_group_nodes = [combined_file_output, light_group_diffuse_output]
+		# the per light outputs are replaced by the light group outputs
+		diffuse_file_output.mute = True
+		specular_file_output.mute = True
+	else:
+		light = new_point_light('Point')
+
+	try:
+		for i in range(len(light_directions)):
+			view_start = time.time()
+			print("Rotation {}, {}".format((stepsize * i), radians(stepsize * i)))
+			file_path  = os.path.join(args.filepath, "obj_rotat" + str(i), "")
+
+			depth_file_output.file_slots[0].path = file_path + "depth"
+			normal_file_output.file_slots[0].path = file_path + "normal"
+
+			if args.auto_frame != 'none':
+				crop_boxes.append(object_pixel_box([obj for obj in bpy.data.objects if obj.type == 'MESH']))
+				set_render_border(crop_boxes[-1])
+				write_crop_manifest(crop_boxes)
+
+			if light_groups:
+				render_view_light_groups(file_path, lights, light_group_nodes, light_directions[i])
 			else:
-				objct = obj
+				render_view_per_light(file_path, output_nodes, light, i, light_directions[i], capture)
+
+			objct = get_mesh_object()
+
+			# rotate object around x and z axis (this is just some arbitrary choice to create different views...)
+			objct.rotation_euler[2] += radians(stepsize / 2)
+			objct.rotation_euler[0] += radians(stepsize / 2)
+			report('view', view=i, lights=len(light_directions[i]), seconds=time.time() - view_start)
+
+		if capture:
+			with timer.phase('write'):
+				capture.writer.close()
+	finally:
+		clear_render_border()
+		if light_groups:
+			remove_light_groups(lights, light_group_nodes)
+			diffuse_file_output.mute = False
+			specular_file_output.mute = False
+		else:
+			remove_light(light)
+		if capture:
+			capture.close()
+
+
+# encode every (view, light) pair as one keyframed frame and render them all as a single animation job,
+# so Cycles keeps its kernels and BVH between frames (use_persistent_data). Frame f (starting at 1) shows
+# view (f - 1) // num_of_lights with light (f - 1) % num_of_lights. Images are written to <filepath>/frames/
+# with the frame number as suffix, frames.json maps every frame to its view and light direction
+def render_animation(output_nodes):
+	normal_file_output, depth_file_output, diffuse_file_output, specular_file_output = output_nodes
+	scene = bpy.context.scene
+	objct = get_mesh_object()
+	stepsize = 360.0 / args.views
+	num_of_lights = args.num_of_lights
+	file_path = os.path.join(args.filepath, "frames", "")
+
+	light = new_point_light('Point')
+	light_directions = get_light_directions()
+
+	base_rotation = objct.rotation_euler.copy()
+	frames = []
+	for i in range(args.views):
+		objct.rotation_euler[2] = base_rotation[2] + i * radians(stepsize / 2)
+		objct.rotation_euler[0] = base_rotation[0] + i * radians(stepsize / 2)
+		for jj in range(num_of_lights):
+			frame = i * num_of_lights + jj + 1
+			x, y, z = light_directions[i, jj]
+			light.location = (x, y, z)
+			objct.keyframe_insert(data_path='rotation_euler', frame=frame)
+			light.keyframe_insert(data_path='location', frame=frame)
+			frames.append({'frame': frame, 'view': i, 'light': jj, 'direction': [float(x), float(y), float(z)]})
+
+	for animated in [objct, light]:
+		for fcurve in animated.animation_data.action.fcurves:
+			for keyframe in fcurve.keyframe_points:
+				keyframe.interpolation = 'CONSTANT'
+
+	os.makedirs(file_path, exist_ok=True)
+	with open(os.path.join(args.filepath, 'frames.json'), 'w') as f:
+		json.dump({'views': args.views, 'num_of_lights': num_of_lights, 'frames': frames}, f, indent=1)
+
+	scene.render.filepath = file_path + 'xyz_'
+	depth_file_output.file_slots[0].path = file_path + "depth"
+	normal_file_output.file_slots[0].path = file_path + "normal"
+	diffuse_file_output.file_slots[0].path = file_path + "diffuse"
+	specular_file_output.file_slots[0].path = file_path + "specular"
+
+	scene.frame_start = 1
+	scene.frame_end = len(frames)
+	scene.render.use_persistent_data = True
+	start = time.time()
+	try:
+		with timer.phase('render_animation'):
+			bpy.ops.render.render(animation=True)
+		report('animation', frames=len(frames), seconds=time.time() - start)
+	finally:
+		scene.render.use_persistent_data = False
+		objct.animation_data_clear()
+		remove_light(light)
+
+
+# renders all views and lights of a single object into args.output_folder/<model_identifier>
+def render_object(obj_filename, output_nodes):
+	model_identifier = args.model_id or os.path.split(os.path.split(obj_filename)[0])[1]
+	args.filepath = os.path.join(args.output_folder, model_identifier)
+	report('start', obj=obj_filename)
+	load_start = time.time()
+	load_object(obj_filename)
+	report('loaded', seconds=time.time() - load_start)
+
+	if args.preview:
+		for option in ['animation', 'light_groups']:
+			if getattr(args, option):
+				print("--{} is ignored in --preview mode".format(option))
+				setattr(args, option, False)
+		if args.output_format != 'png':
+			print("--preview writes png images")
+			args.output_format = 'png'
+
+	if args.animation:
+		if args.light_groups:
+			print("--light_groups is ignored in --animation mode")
+		if args.output_format != 'png':
+			raise ValueError("--animation only writes png images")
+		if args.auto_frame != 'none':
+			print("--auto_frame is ignored in --animation mode")
+		render_animation(output_nodes)
+	else:
+		render_views(output_nodes)
+
+
+def main_flow():
+	with timer.phase('setup_nodes'):
+		output_nodes = setup_nodes()
+		setup_camera()
+	render_object(args.obj, output_nodes)
+
+
+# job keys a server accepts from the driver. Everything baked into the node tree or the camera
+# (depth_scale, color_depth, resolution) is fixed when the server starts.
+SERVER_JOB_KEYS = ['obj', 'model_id', 'output_folder', 'views', 'num_of_lights', 'scale', 'light_groups', 'animation', 'output_format', 'light_sampling', 'seed', 'auto_frame', 'telemetry']
+SERVER_READY = 'RENDER_SERVER_READY'
+SERVER_RESPONSE = 'RENDER_SERVER_DONE '
+
+
+# build the node tree and camera once, then render one object per stdin line.
+# Each line is a JSON object with keys from SERVER_JOB_KEYS, each answer is a single
+# SERVER_RESPONSE prefixed JSON line on stdout (blender's own output is interleaved with it).
+def server_flow():
+	with timer.phase('setup_nodes'):
+		output_nodes = setup_nodes()
+		setup_camera()
+	defaults = {key: getattr(args, key) for key in SERVER_JOB_KEYS}
+	print(SERVER_READY, flush=True)
+
+	for line in sys.stdin:
+		line = line.strip()
+		if not line:
+			continue
+		response = {'status': 'ok'}
+		try:
+			job = json.loads(line)
+			unknown = set(job) - set(SERVER_JOB_KEYS)
+			if unknown:
+				raise ValueError("Unsupported job keys: {}".format(sorted(unknown)))
+			response['obj'] = job.get('obj')
+			for key, value in defaults.items():
+				setattr(args, key, job.get(key, value))
+			render_object(args.obj, output_nodes)
+		except Exception:
+			print(sys.exc_info())
+			response['status'] = 'error'
+			response['error'] = repr(sys.exc_info()[1])
+		finally:
+			# only the mesh goes away between jobs, nodes and camera are kept
+			clear_scene()
+		print(SERVER_RESPONSE + json.dumps(response), flush=True)
 
-		# rotate object around x and z axis (this is just some arbitrary choice to create different views...)
-		objct.rotation_euler[2] += radians(stepsize / 2)
-		objct.rotation_euler[0] += radians(stepsize / 2)
 
 # return exit code different than 0 if some exception is thrown
 try: 
-	main_flow()
+	if args.server:
+		server_flow()
+	else:
+		main_flow()
 except:
 	print(sys.exc_info())
 	sys.exit(1)
+finally:
+	if args.timings:
+		timer.write(args.timings, obj=args.obj, views=args.views, num_of_lights=args.num_of_lights,
+			resolution=args.resolution, color_depth=args.color_depth)
 
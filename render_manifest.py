@@ -0,0 +1,69 @@
+# Append-only completion manifest for batch rendering.
+# Every finished (or failed) object is written as one JSON line, keyed by the sha256 of the
+# .obj content together with the render arguments and output directory. A restarted batch
+# reads the file back and skips objects that were already completed with identical arguments.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# key identifying an object rendered into output_dir with a given set of parameters.
+# The output directory is part of the key so identical meshes in different folders all get rendered
+def job_key(content_hash, params, output_dir):
+    payload = json.dumps({'hash': content_hash, 'params': params, 'output': output_dir}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RenderManifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # key -> last record written for it
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # line cut short by a crash
+                    self.entries[record['key']] = record
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a')
+
+    def status(self, key):
+        record = self.entries.get(key)
+        return record['status'] if record else None
+
+    # number of recorded runs of a job, counting the earlier ones its last record was a retry of
+    def attempts(self, key):
+        record = self.entries.get(key)
+        return record.get('attempt', 1) if record else 0
+
+    def failed(self):
+        return [record for record in self.entries.values() if record['status'] != 'ok']
+
+    def record(self, key, obj_file, content_hash, params, status, **extra):
+        record = dict(key=key, obj=obj_file, hash=content_hash, params=params, status=status, time=time.time(), **extra)
+        with self.lock:
+            self.entries[key] = record
+            self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return record
+
+    def close(self):
+        with self.lock:
+            self.file.close()
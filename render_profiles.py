@@ -0,0 +1,18 @@
+# Named Cycles quality profiles of render_blender.py, trading image quality for throughput.
+# Kept free of bpy so the batch driver can check --profile and derive its thread caps from them.
+#
+# threads is the Cycles thread count of one render (capped at the number of cores), 0 uses every core.
+# Cheap renders spend a large share of their time in single threaded work (scene sync, compositing,
+# PNG writes), so the low sample profiles use few threads and leave the other cores to more batch
+# workers. tile_size is a render tile edge in pixels (small tiles suit CPUs before blender 3.0)
+
+RENDER_PROFILES = {
+    'draft':          dict(samples=16,  adaptive_threshold=0.1,   denoiser='OPENIMAGEDENOISE', tile_size=64,   max_bounces=2,  threads=4),
+    'fast':           dict(samples=64,  adaptive_threshold=0.05,  denoiser='OPENIMAGEDENOISE', tile_size=256,  max_bounces=4,  threads=8),
+    'balanced':       dict(samples=128, adaptive_threshold=0.01,  denoiser='OPENIMAGEDENOISE', tile_size=256,  max_bounces=8,  threads=16),
+    'high':           dict(samples=512, adaptive_threshold=0.005, denoiser='NONE',             tile_size=2048, max_bounces=12, threads=0),
+    # best images per hour on a CPU node: few samples, early adaptive stop, cheap denoising, CPU sized
+    # tiles and two threads per render, with one batch worker per two cores
+    'cpu_throughput': dict(samples=32,  adaptive_threshold=0.05,  denoiser='OPENIMAGEDENOISE', tile_size=32,   max_bounces=3,  threads=2),
+}
+RENDER_PROFILE_KEYS = ['samples', 'adaptive_threshold', 'denoiser', 'tile_size', 'max_bounces', 'threads']
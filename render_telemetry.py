@@ -0,0 +1,159 @@
+# Structured telemetry of batch renders.
+#
+# The batch driver appends one JSON object per line to its telemetry file: a 'batch_start' and
+# 'batch_end' record, one 'object' record per rendered object (status, cause of a failure, wall
+# time, peak RSS of the blender child, images produced, attempt, per view timings) and periodic
+# 'progress' records with throughput and ETA.
+#
+# The render script reports its per view and per light timings over a side channel: an events
+# file per object (render_blender.py --telemetry <file>) that it appends to as it goes, so the
+# driver still knows how far a render got when it had to be killed.
+
+import json
+import os
+import threading
+import time
+
+
+class TelemetryLog:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a')
+
+    def emit(self, event, **fields):
+        record = dict(fields, event=event, time=time.time())
+        with self.lock:
+            self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+        return record
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# used by the render script, opens the file per event so every line is on disk when blender gets killed
+def append_event(path, event, **fields):
+    with open(path, 'a') as f:
+        f.write(json.dumps(dict(fields, event=event, time=time.time()), sort_keys=True) + '\n')
+
+
+def read_events(path):
+    events = []
+    if not os.path.isfile(path):
+        return events
+    with open(path) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue  # line cut short by a kill
+    return events
+
+
+# summary of an object's render events: view and light timings and the last thing that was done
+def summarize_events(events):
+    views = [{'view': event['view'], 'seconds': event['seconds']} for event in events if event['event'] == 'view']
+    lights = [event['seconds'] for event in events if event['event'] == 'light']
+    summary = {'views': views, 'views_done': len(views)}
+    if lights:
+        summary['light_seconds_mean'] = sum(lights) / len(lights)
+        summary['light_seconds_max'] = max(lights)
+    if events:
+        last = events[-1]
+        summary['last_event'] = {key: last[key] for key in ('event', 'view', 'light') if key in last}
+    return summary
+
+
+# PNG files plus the images stored in packed npy output below directory
+def count_images(directory):
+    images = 0
+    for root, dirs, files in os.walk(directory):
+        images += sum(1 for name in files if name.endswith('.png'))
+        if 'index.json' in files and os.path.basename(root) == 'packed':
+            with open(os.path.join(root, 'index.json')) as f:
+                passes = json.load(f)['passes']
+            # (views, H, W) and (views, H, W, 3) per view, (views, lights, H, W, 3) per light
+            for info in passes.values():
+                shape = info['shape']
+                images += shape[0] * shape[1] if len(shape) == 5 else shape[0]
+    return images
+
+
+# throughput and ETA of a running batch. Until the number of objects is known (total), it is
+# estimated from the objects found in the share of the directory tree walked so far, capped at limit.
+# Objects that are rendered again after failing validation are added to it
+class Progress:
+    def __init__(self, workers, limit=None):
+        self.workers = workers
+        self.limit = limit
+        self.start = time.time()
+        self.total = None
+        self.found = 0
+        self.walked_share = 0.0
+        self.requeued = 0
+        self.finished = 0
+        self.rendered = 0
+        self.images = 0
+        self.render_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, status, wall=0.0, images=0):
+        with self.lock:
+            self.finished += 1
+            if status != 'skipped':
+                self.rendered += 1
+                self.render_seconds += wall
+            self.images += images
+
+    def requeue(self):
+        with self.lock:
+            self.requeued += 1
+
+    def found_object(self):
+        with self.lock:
+            self.found += 1
+
+    def walked(self, share):
+        with self.lock:
+            self.walked_share = share
+
+    def _total(self):
+        if self.total is not None:
+            return self.total, False
+        if not self.found or not self.walked_share:
+            return None, True
+        estimate = int(round(self.found / self.walked_share))
+        return min(estimate, self.limit) if self.limit is not None else estimate, True
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            total, estimated = self._total()
+            if total is not None:
+                total += self.requeued
+            snapshot = {'finished': self.finished, 'total': total, 'total_estimated': estimated, 'elapsed': elapsed,
+                        'objects_per_hour': self.finished / elapsed * 3600 if elapsed > 0 else 0.0,
+                        'images_per_sec': self.images / elapsed if elapsed > 0 else 0.0, 'eta': None}
+            if total is not None and self.rendered:
+                # remaining objects at the mean render time seen so far, spread over the workers
+                remaining = max(total - self.finished, 0)
+                snapshot['eta'] = remaining * self.render_seconds / self.rendered / self.workers
+            return snapshot
+
+    def summary(self):
+        snapshot = self.snapshot()
+        total = '?' if snapshot['total'] is None else ('~' if snapshot['total_estimated'] else '') + str(snapshot['total'])
+        eta = 'unknown' if snapshot['eta'] is None else format_duration(snapshot['eta'])
+        return "{}/{} objects in {}, {:.1f} objects/h, {:.2f} images/s, ETA {}".format(
+            snapshot['finished'], total, format_duration(snapshot['elapsed']), snapshot['objects_per_hour'],
+            snapshot['images_per_sec'], eta)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,56 @@
+# Wall clock time per phase of a render run (import, mesh cleanup, node setup, renders, writes).
+#
+# Phases nest: time spent in an inner phase is not counted for the phase around it, so the totals
+# of all phases add up to the time spent inside any phase. Only the standard library is needed,
+# the module is shared by the render script (inside blender) and the benchmark harness.
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# set by the benchmark harness to time.time() right before blender is started
+LAUNCH_TIME_ENV = 'RENDER_LAUNCH_TIME'
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}  # name -> [count, exclusive seconds]
+        self.stack = []  # [name, start, seconds spent in nested phases]
+
+    @contextmanager
+    def phase(self, name):
+        frame = [name, time.perf_counter(), 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            self.add(name, elapsed - frame[2])
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def add(self, name, seconds):
+        count_total = self.phases.setdefault(name, [0, 0.0])
+        count_total[0] += 1
+        count_total[1] += seconds
+
+    # blender startup as seen from the launcher, if it told us when it started the process
+    def add_startup(self):
+        launch_time = os.environ.get(LAUNCH_TIME_ENV)
+        if launch_time:
+            self.add('startup', self.start - float(launch_time))
+
+    def summary(self):
+        return {name: {'count': count, 'total': total, 'mean': total / count}
+                for name, (count, total) in self.phases.items()}
+
+    def write(self, path, **extra):
+        report = dict(extra, wall=time.time() - self.start, phases=self.summary())
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,81 @@
+# Stand-in for blender's bmesh, only what render_blender.py uses. The operations do comparable
+# work on numpy arrays so mesh size still shows up in the cleanup timings
+import numpy as np
+
+
+class Edge:
+    __slots__ = ['link_faces', 'angle']
+
+    def __init__(self, link_faces, angle):
+        self.link_faces = link_faces
+        self.angle = angle
+
+    def calc_face_angle(self, fallback=None):
+        return fallback if self.angle is None else self.angle
+
+
+class BMesh:
+    def __init__(self):
+        self.vertices = np.zeros((0, 3))
+        self.faces = np.zeros((0, 3), dtype=np.int64)
+        self._edges = None
+
+    @property
+    def verts(self):
+        return self.vertices
+
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = self._build_edges()
+        return self._edges
+
+    def _build_edges(self):
+        corners = self.vertices[self.faces]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-20)
+        pairs = np.sort(self.faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        face_of_pair = np.repeat(np.arange(len(self.faces)), 3)
+        unique, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        edges = []
+        for edge in range(len(unique)):
+            faces = tuple(face_of_pair[order[bounds[edge]:bounds[edge + 1]]])
+            angle = None
+            if len(faces) == 2:
+                angle = float(np.arccos(np.clip(normals[faces[0]] @ normals[faces[1]], -1, 1)))
+            edges.append(Edge(faces, angle))
+        return edges
+
+    def from_mesh(self, mesh):
+        self.vertices = np.array(mesh.vertices, dtype=np.float64)
+        self.faces = np.array(mesh.faces, dtype=np.int64)
+        self._edges = None
+
+    def to_mesh(self, mesh):
+        mesh.vertices = self.vertices
+        mesh.faces = self.faces
+
+    def free(self):
+        self.vertices = self.faces = self._edges = None
+
+
+def new():
+    return BMesh()
+
+
+class ops:
+    @staticmethod
+    def remove_doubles(bm, verts, dist):
+        keys = np.round(bm.vertices / dist).astype(np.int64)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        bm.vertices = bm.vertices[first]
+        bm.faces = inverse.reshape(-1)[bm.faces]
+        bm._edges = None
+
+    @staticmethod
+    def split_edges(bm, edges):
+        # the split only changes shading, the stub renderer does not shade
+        return {'edges': edges}
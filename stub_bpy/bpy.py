@@ -0,0 +1,406 @@
+# Stand-in for blender's bpy module, so render_blender.py can run under plain python.
+#
+# It covers only what render_blender.py touches. Settings are plain attributes, the OBJ importer
+# parses the file with numpy, and a render writes a synthetic image for every unmuted file output
+# node (PNG, or EXR slots as raw arrays) with the same names and frame numbers blender would use.
+# Nothing is shaded, so timings show the orchestration and I/O overhead of the render script.
+# Set STUB_BPY_RENDER_SECONDS to add a fixed delay to every render call.
+
+import os
+import pickle
+import time
+import zlib
+from contextlib import contextmanager
+from math import radians
+
+import numpy as np
+
+from mathutils import Matrix
+
+RENDER_SECONDS = float(os.environ.get('STUB_BPY_RENDER_SECONDS', 0))
+
+
+# any attribute or key that was never set reads as a fresh Namespace, calls do nothing
+class Namespace:
+    def __init__(self, **values):
+        self.__dict__.update(values)
+        self.__dict__['_items'] = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = self.__dict__[name] = Namespace()
+        return value
+
+    def __getitem__(self, key):
+        return self._items.setdefault(key, Namespace())
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+
+class Collection(list):
+    def __init__(self, factory=None):
+        super().__init__()
+        self.factory = factory
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for item in self:
+                if item.name == key:
+                    return item
+            raise KeyError(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            return any(item.name == key for item in self)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def new(self, *args, **kwargs):
+        item = self.factory(*args, **kwargs)
+        self.append(item)
+        return item
+
+    def remove(self, item, do_unlink=False):
+        super().remove(item)
+        if do_unlink and item in scene.objects:
+            scene.objects.remove(item)
+
+
+class Datablock(Namespace):
+    @property
+    def users(self):
+        return sum(1 for obj in data.objects if obj.data is self)
+
+
+class Mesh(Datablock):
+    def __init__(self, name, vertices, faces):
+        super().__init__(name=name, vertices=vertices, faces=faces, use_auto_smooth=False)
+
+    def transform(self, matrix):
+        values = matrix.values
+        self.vertices = self.vertices @ values[:3, :3].T + values[:3, 3]
+
+    @property
+    def polygons(self):
+        return self.faces
+
+    def update(self):
+        pass
+
+
+class Light(Datablock):
+    def __init__(self, name, type='POINT'):
+        super().__init__(name=name, type=type, energy=10.0)
+
+
+class Modifier(Namespace):
+    def __init__(self, name, type):
+        super().__init__(name=name, type=type, ratio=1.0)
+
+
+class Object(Namespace):
+    def __init__(self, name, object_data=None, type=None):
+        if type is None:
+            type = 'LIGHT' if isinstance(object_data, Light) else 'MESH' if isinstance(object_data, Mesh) else 'EMPTY'
+        super().__init__(name=name, data=object_data, type=type, location=[0.0, 0.0, 0.0],
+                         rotation_euler=[0.0, 0.0, 0.0], lightgroup='', animation_data=None,
+                         modifiers=Collection(Modifier))
+
+    # a decimate modifier keeps an evenly spread subset of the faces, the vertices stay as they are
+    def evaluated_get(self, depsgraph):
+        faces = self.data.faces
+        for modifier in self.modifiers:
+            if modifier.type == 'DECIMATE':
+                keep = max(1, int(round(len(faces) * modifier.ratio)))
+                faces = faces[np.linspace(0, len(faces) - 1, keep).astype(int)]
+        return Object(self.name, Mesh(self.data.name, self.data.vertices, faces))
+
+    @property
+    def matrix_world(self):
+        from rasterize_geometry import euler_xyz
+        values = np.eye(4)
+        values[:3, :3] = euler_xyz(*self.rotation_euler)
+        values[:3, 3] = self.location
+        return Matrix(values)
+
+    @property
+    def bound_box(self):
+        low, high = self.data.vertices.min(axis=0), self.data.vertices.max(axis=0)
+        return [[(low, high)[i >> 2 & 1][0], (low, high)[i >> 1 & 1][1], (low, high)[i & 1][2]] for i in range(8)]
+
+    def keyframe_insert(self, data_path, frame):
+        if self.animation_data is None:
+            self.animation_data = Namespace(action=Namespace(fcurves=[]))
+        self.animation_data.action.fcurves.append(Namespace(keyframe_points=[Namespace()]))
+
+    def animation_data_clear(self):
+        self.animation_data = None
+
+
+class Socket(Namespace):
+    pass
+
+
+class Sockets(Namespace):
+    def __getitem__(self, key):
+        return self._items.setdefault(key, Socket())
+
+    def get(self, key, default=None):
+        return self[key]
+
+
+class Node(Namespace):
+    TYPES = {'CompositorNodeRLayers': 'R_LAYERS', 'CompositorNodeOutputFile': 'OUTPUT_FILE'}
+
+    def __init__(self, type):
+        super().__init__(type=self.TYPES.get(type, type), label='', mute=False, base_path='tmp/',
+                         inputs=Sockets(), outputs=Sockets(),
+                         format=Namespace(file_format='PNG', color_depth='8', color_mode='RGBA', compression=15))
+        self.file_slots = Collection(lambda name: Namespace(name=name, path=name))
+        self.file_slots.new('Image')
+
+
+class NodeTree(Namespace):
+    def __init__(self):
+        super().__init__(nodes=NodeList(Node), links=Namespace())
+
+
+class NodeList(Collection):
+    # blender tolerates removing nodes while iterating the tree
+    def __iter__(self):
+        return iter(list(super().__iter__()))
+
+    def new(self, type):
+        return super().new(type)
+
+
+class Pixels:
+    def __init__(self, values):
+        self.values = values
+
+    def foreach_get(self, out):
+        out[:] = self.values
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+
+class Image(Namespace):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            pixels = np.load(f)  # top row first, blender keeps the bottom row first
+        height, width = pixels.shape[:2]
+        super().__init__(size=(width, height), pixels=Pixels(pixels[::-1].reshape(-1)), users=0)
+
+
+class Images(Collection):
+    def load(self, path, check_existing=False):
+        image = Image(path)
+        self.append(image)
+        return image
+
+
+class Libraries(Collection):
+    @contextmanager
+    def load(self, path):
+        with open(path, 'rb') as f:
+            objects = pickle.load(f)
+        data_from = Namespace(objects=[obj.name for obj in objects])
+        data_to = Namespace(objects=[])
+        yield data_from, data_to
+        data_to.objects = [obj for obj in objects if obj.name in data_to.objects]
+        for obj in data_to.objects:
+            data.meshes.append(obj.data)
+
+    def write(self, path, datablocks):
+        with open(path, 'wb') as f:
+            pickle.dump(list(datablocks), f)
+
+
+class SceneObjects(Collection):
+    def link(self, obj):
+        if obj not in data.objects:
+            data.objects.append(obj)
+        if obj not in self:
+            self.append(obj)
+
+
+class Meshes(Collection):
+    def new_from_object(self, obj):
+        mesh = Mesh(obj.data.name, obj.data.vertices, obj.data.faces)
+        self.append(mesh)
+        return mesh
+
+
+data = Namespace(
+    objects=Collection(lambda name, object_data: Object(name, object_data)),
+    meshes=Meshes(),
+    materials=Collection(),
+    textures=Collection(),
+    lights=Collection(Light),
+    actions=Collection(),
+    images=Images(),
+    libraries=Libraries(),
+)
+
+scene = Namespace(
+    objects=SceneObjects(),
+    use_nodes=False,
+    node_tree=NodeTree(),
+    frame_current=1, frame_start=1, frame_end=250,
+    render=Namespace(resolution_x=1920, resolution_y=1080, resolution_percentage=100, filepath='/tmp/',
+                     use_border=False, use_crop_to_border=False, use_persistent_data=False,
+                     border_min_x=0.0, border_max_x=1.0, border_min_y=0.0, border_max_y=1.0,
+                     image_settings=Namespace(file_format='PNG', color_depth='8', color_mode='RGBA', compression=15)),
+    cycles=Namespace(samples=128),
+)
+scene.collection = Namespace(objects=scene.objects)
+
+
+def _startup_scene():
+    camera = Object('Camera', type='CAMERA')
+    cube = Object('Cube', Mesh('Cube', np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], float),
+                              np.array([[0, 1, 3], [0, 3, 2]])))
+    light = Object('Light', Light('Light'))
+    for obj in [camera, cube, light]:
+        scene.objects.link(obj)
+    data.meshes.append(cube.data)
+    data.lights.append(light.data)
+
+
+_startup_scene()
+
+preferences = Namespace()
+preferences.addons['cycles'].preferences = Namespace(get_devices=lambda: None, refresh_devices=lambda: None, devices=[])
+context = Namespace(scene=scene, preferences=preferences, view_layer=Namespace(),
+                    evaluated_depsgraph_get=lambda: Namespace())
+
+app = Namespace(version=(3, 3, 1))
+types = Namespace(Image=Image)
+
+
+# synthetic float pixels, cached per image size and output so they cost nothing to produce
+_pixel_cache = {}
+
+
+def _pixels(height, width, name):
+    key = (height, width, name)
+    if key not in _pixel_cache:
+        rng = np.random.default_rng(zlib.crc32(repr(key).encode('utf-8')))
+        gradient = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+        noise = rng.random((height, width, 3), dtype=np.float32) * 0.1
+        _pixel_cache[key] = np.clip(gradient * 0.9 + noise, 0, 1)
+    return _pixel_cache[key]
+
+
+def _image_size():
+    render = scene.render
+    width = render.resolution_x * render.resolution_percentage // 100
+    height = render.resolution_y * render.resolution_percentage // 100
+    if render.use_border and render.use_crop_to_border:
+        width = max(1, int(round((render.border_max_x - render.border_min_x) * width)))
+        height = max(1, int(round((render.border_max_y - render.border_min_y) * height)))
+    return height, width
+
+
+# rows and columns a border render (without cropping) leaves unrendered: every pass is 0 there
+def _outside_border(height, width):
+    render = scene.render
+    outside = np.zeros((height, width), dtype=bool)
+    if render.use_border and not render.use_crop_to_border:
+        outside[:] = True
+        y0, y1 = int(round((1 - render.border_max_y) * height)), int(round((1 - render.border_min_y) * height))
+        x0, x1 = int(round(render.border_min_x * width)), int(round(render.border_max_x * width))
+        outside[y0:y1, x0:x1] = False
+    return outside
+
+
+def _frame_path(path, frame):
+    if '#' in path:
+        digits = path.count('#')
+        return path.replace('#' * digits, str(frame).zfill(digits), 1)
+    return path + '{:04d}'.format(frame)
+
+
+def _write_image(path, pixels, image_format):
+    from packed_output import quantize
+    from png_io import write_png
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if image_format.file_format == 'OPEN_EXR':
+        alpha = np.ones(pixels.shape[:2] + (1,), dtype=np.float32)
+        with open(path, 'wb') as f:
+            np.save(f, np.concatenate([pixels, alpha], axis=2))
+        return
+    dtype = np.uint16 if str(image_format.color_depth) == '16' else np.uint8
+    compression = getattr(image_format, 'compression', 15)
+    write_png(path, quantize(pixels, dtype), int(round(compression * 9 / 100.0)))
+
+
+def _render_frame(frame, write_still):
+    if RENDER_SECONDS:
+        time.sleep(RENDER_SECONDS)
+    height, width = _image_size()
+    outside = _outside_border(height, width)
+
+    def pixels_of(name):
+        pixels = _pixels(height, width, name)
+        return np.where(outside[..., None], 0, pixels) if outside.any() else pixels
+
+    for node in scene.node_tree.nodes:
+        if node.type != 'OUTPUT_FILE' or node.mute:
+            continue
+        extension = '.exr' if node.format.file_format == 'OPEN_EXR' else '.png'
+        for slot in node.file_slots:
+            _write_image(_frame_path(node.base_path + slot.path, frame) + extension, pixels_of(node.label + slot.name),
+                         node.format)
+    if write_still:
+        _write_image(scene.render.filepath + '.png', pixels_of('Combined'), scene.render.image_settings)
+
+
+class _RenderOps:
+    @staticmethod
+    def render(write_still=False, animation=False):
+        if not animation:
+            _render_frame(scene.frame_current, write_still)
+            return {'FINISHED'}
+        current = scene.frame_current
+        try:
+            for frame in range(scene.frame_start, scene.frame_end + 1):
+                scene.frame_current = frame
+                # animations name the combined image like the file output nodes do
+                filepath = scene.render.filepath
+                scene.render.filepath = _frame_path(filepath, frame)
+                try:
+                    _render_frame(frame, True)
+                finally:
+                    scene.render.filepath = filepath
+        finally:
+            scene.frame_current = current
+        return {'FINISHED'}
+
+
+class _ImportOps:
+    @staticmethod
+    def obj(filepath):
+        from rasterize_geometry import load_obj
+        vertices, faces = load_obj(filepath)
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        mesh = Mesh(name, vertices, faces)
+        data.meshes.append(mesh)
+        obj = Object(name, mesh)
+        obj.rotation_euler = [radians(90), 0.0, 0.0]  # the importer's Y up to Z up conversion
+        scene.objects.link(obj)
+        return {'FINISHED'}
+
+
+ops = Namespace(render=_RenderOps, import_scene=_ImportOps)
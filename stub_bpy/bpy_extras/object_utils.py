@@ -0,0 +1,14 @@
+# Stand-in for bpy_extras.object_utils, projects with the camera model of rasterize_geometry.py
+import numpy as np
+
+from mathutils import Vector
+from rasterize_geometry import camera
+
+
+def world_to_camera_view(scene, cam, coord):
+    world_to_camera, tan_half_fov = camera()
+    x, y, z = world_to_camera @ (np.asarray(list(coord)) - np.asarray(cam.location, dtype=np.float64))
+    depth = -z
+    if depth == 0:
+        return Vector((0.5, 0.5, 0))
+    return Vector(((x / depth / tan_half_fov + 1) / 2, (y / depth / tan_half_fov + 1) / 2, depth))
@@ -0,0 +1,33 @@
+# Stand-in for blender's mathutils, only what render_blender.py uses
+import numpy as np
+
+
+class Vector:
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float64)
+
+    x = property(lambda self: self.values[0])
+    y = property(lambda self: self.values[1])
+    z = property(lambda self: self.values[2])
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+
+class Matrix:
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float64)
+
+    @staticmethod
+    def Scale(factor, size):
+        values = np.eye(size) * factor
+        values[size - 1, size - 1] = 1
+        return Matrix(values)
+
+    def __matmul__(self, other):
+        if isinstance(other, Vector):
+            return Vector((self.values @ np.r_[other.values, 1])[:3])
+        return Matrix(self.values @ other.values)
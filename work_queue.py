@@ -0,0 +1,239 @@
+# Work distribution for batch rendering on several nodes without a central service.
+#
+# Static: shard_of() assigns every object to one of N shards by a hash of its path relative to the
+# catalogue root, so -shard i/N on each node renders a fixed, disjoint part of the catalogue.
+#
+# Dynamic: LeaseQueue coordinates nodes through lease files in a directory all of them can reach
+# (NFS, SMB, ...). Every node walks the whole catalogue and claims objects one at a time:
+#
+#   <queue>/leases/<key>/<generation>   a node holds an object while it is rendering it
+#   <queue>/done/<key>.json             the object was processed, with its status and node
+#
+# Claiming creates the next generation file with O_CREAT | O_EXCL, which only one node can win,
+# and is only allowed when there is no lease yet or the newest one expired: its mtime is older than
+# lease_seconds. Holders refresh the mtime of their leases from a heartbeat thread, so the leases of
+# a crashed node expire and its objects are claimed again by the others. A node whose lease was
+# taken over (a newer generation exists) notices it on the next heartbeat. Lease expiry compares
+# file mtimes set by the file server with the local clock, lease_seconds has to be much larger
+# than the clock skew between nodes. SQLite was not used, its locking is unreliable on network file systems.
+#
+# python work_queue.py -queue /tmp/queue -nodes 3 -objects 30 -crash 1 simulates nodes as local processes
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+# shard (0 .. shards - 1) of an object, stable across nodes, runs and listing orders
+def shard_of(relative_path, shards):
+    digest = hashlib.sha256(relative_path.replace(os.sep, '/').encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little') % shards
+
+
+# parses 'i/N' into (i, N)
+def parse_shard(value):
+    try:
+        index, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like i/N, got {}".format(value))
+    if shards < 1 or not 0 <= index < shards:
+        raise argparse.ArgumentTypeError("shard index must be in 0..N-1, got {}".format(value))
+    return index, shards
+
+
+def object_key(relative_path):
+    return hashlib.sha1(relative_path.replace(os.sep, '/').encode('utf-8')).hexdigest()
+
+
+class LeaseQueue:
+    CLAIMED, DONE, HELD = 'claimed', 'done', 'held'
+
+    def __init__(self, queue_dir, node=None, lease_seconds=120, retry_failed=False):
+        self.queue_dir = queue_dir
+        self.node = node or socket.gethostname()
+        self.lease_seconds = lease_seconds
+        self.retry_failed = retry_failed
+        self.leases_dir = os.path.join(queue_dir, 'leases')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        os.makedirs(self.leases_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self.held = {}  # key -> generation of the lease this node holds
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, name='lease_heartbeat', daemon=True)
+        self.heartbeat.start()
+
+    def _done_path(self, key):
+        return os.path.join(self.done_dir, key + '.json')
+
+    def _lease_path(self, key, generation):
+        return os.path.join(self.leases_dir, key, str(generation))
+
+    def _generations(self, key):
+        try:
+            return sorted(int(name) for name in os.listdir(os.path.join(self.leases_dir, key)) if name.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def is_done(self, key):
+        try:
+            with open(self._done_path(key)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return record.get('status') in ('ok', 'skipped') or not self.retry_failed
+
+    def _expired(self, key, generation):
+        try:
+            return time.time() - os.stat(self._lease_path(key, generation)).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return True  # released
+
+    # returns CLAIMED when this node now holds the object, DONE when it was already processed
+    # and HELD when another node holds a live lease on it
+    def claim(self, key, obj_file=None):
+        if self.is_done(key):
+            return self.DONE
+        generations = self._generations(key)
+        if generations and not self._expired(key, generations[-1]):
+            return self.HELD
+        generation = generations[-1] + 1 if generations else 0
+        os.makedirs(os.path.join(self.leases_dir, key), exist_ok=True)
+        try:
+            fd = os.open(self._lease_path(key, generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileExistsError, FileNotFoundError):
+            return self.HELD  # another node claimed it at the same moment, or just cleaned up the directory
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'node': self.node, 'pid': os.getpid(), 'obj': obj_file, 'claimed': time.time()}, f)
+        if generations:
+            logging.warning("Reclaimed expired lease of {} (generation {})".format(obj_file or key, generations[-1]))
+        # a node could have finished it between the check above and the claim
+        if self.is_done(key):
+            self._remove_leases(key, generation)
+            return self.DONE
+        with self.lock:
+            self.held[key] = generation
+        self._remove_leases(key, generation - 1)
+        return self.CLAIMED
+
+    # stale generations up to and including generation are not needed any more
+    def _remove_leases(self, key, generation):
+        for old in self._generations(key):
+            if old <= generation:
+                try:
+                    os.remove(self._lease_path(key, old))
+                except OSError:
+                    pass
+        try:
+            os.rmdir(os.path.join(self.leases_dir, key))  # only succeeds once no lease is left
+        except OSError:
+            pass
+
+    # records the outcome of a claimed object and gives up the lease
+    def complete(self, key, status, obj_file=None):
+        tmp_path = '{}.{}.{}.tmp'.format(self._done_path(key), self.node, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'status': status, 'node': self.node, 'obj': obj_file, 'time': time.time()}, f)
+        os.replace(tmp_path, self._done_path(key))
+        self.release(key)
+
+    def release(self, key):
+        with self.lock:
+            generation = self.held.pop(key, None)
+        if generation is not None:
+            self._remove_leases(key, generation)
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease_seconds / 4.0):
+            with self.lock:
+                held = list(self.held.items())
+            for key, generation in held:
+                if self._generations(key)[-1:] != [generation]:
+                    logging.warning("Lease on {} was taken over by another node".format(key))
+                    with self.lock:
+                        self.held.pop(key, None)
+                    continue
+                try:
+                    os.utime(self._lease_path(key, generation))
+                except OSError:
+                    logging.warning("Can't renew the lease on {}".format(key))
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        with self.lock:
+            keys = list(self.held)
+        for key in keys:
+            self.release(key)
+
+
+def _simulated_node(queue_dir, node, objects, seconds, lease_seconds, crash_after):
+    queue = LeaseQueue(queue_dir, node, lease_seconds)
+    processed = 0
+    held = list(range(objects))
+    while held:
+        waiting = []
+        for index in held:
+            key = object_key('object{:04d}/model.obj'.format(index))
+            state = queue.claim(key, str(index))
+            if state == LeaseQueue.HELD:
+                waiting.append(index)
+            elif state == LeaseQueue.CLAIMED:
+                if crash_after is not None and processed == crash_after:
+                    os._exit(1)  # dies holding the lease, like a node losing power
+                time.sleep(seconds)
+                queue.complete(key, 'ok', str(index))
+                processed += 1
+        held = waiting
+        if held:
+            time.sleep(lease_seconds / 4.0)
+    queue.close()
+
+
+# local stand-in for a multi node run: processes share a queue directory, one of them can crash
+def simulate(queue_dir, nodes, objects, seconds, lease_seconds, crash):
+    import multiprocessing
+    processes = []
+    for i in range(nodes):
+        crash_after = 1 if i < crash else None
+        process = multiprocessing.Process(target=_simulated_node, name='node{}'.format(i),
+                                          args=(queue_dir, 'node{}'.format(i), objects, seconds, lease_seconds, crash_after))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+    done_by = {}
+    done_dir = os.path.join(queue_dir, 'done')
+    for index in range(objects):
+        path = os.path.join(done_dir, object_key('object{:04d}/model.obj'.format(index)) + '.json')
+        if os.path.isfile(path):
+            with open(path) as f:
+                node = json.load(f)['node']
+            done_by[node] = done_by.get(node, 0) + 1
+    finished = sum(done_by.values())
+    print("{} of {} objects done, per node: {}".format(finished, objects, done_by))
+    print("exit codes: {}".format([process.exitcode for process in processes]))
+    return finished == objects
+
+
+if __name__ == '__main__':
+    import shutil
+    import sys
+
+    parser = argparse.ArgumentParser(description='Simulate several render nodes sharing a lease queue')
+    parser.add_argument('-queue', type=str, required=True, help='queue directory, emptied first')
+    parser.add_argument('-nodes', type=int, default=3)
+    parser.add_argument('-objects', type=int, default=30)
+    parser.add_argument('-seconds', type=float, default=0.05, help='simulated render time per object')
+    parser.add_argument('-lease_seconds', type=float, default=1.0)
+    parser.add_argument('-crash', type=int, default=1, help='number of nodes that die while holding a lease')
+    args = parser.parse_args()
+
+    shutil.rmtree(args.queue, ignore_errors=True)
+    sys.exit(0 if simulate(args.queue, args.nodes, args.objects, args.seconds, args.lease_seconds, args.crash) else 1)